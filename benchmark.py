@@ -0,0 +1,373 @@
+import re
+import json
+import time
+import random
+import argparse
+import types
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+from common.base import DECODING_PROFILES, IGNORE_INDEX
+from common.device import RSSPeak, peak_memory_mb
+from common.prompt import PROMPT_DICT
+from common.masking import mask_spans
+
+from core.seq2seq.chatglm import ChatGLMSeq2Seq, ChatGLMCollator
+from core.seq2seq.llama import LLAMASeq2Seq
+from core.seq2seq.bloom import BLoomSeq2Seq
+from core.seq2seq.qwen import QwenSeq2Seq
+from core.seq2seq.baichuan import BaichuanSeq2Seq
+
+from core.classify.llama import LLAMAClassify
+from core.classify.bloom import BLoomClassify
+
+
+SEQ2SEQ = {
+    "llama": LLAMASeq2Seq,
+    "llama2": LLAMASeq2Seq,
+    "chatglm": ChatGLMSeq2Seq,
+    "chatglm2": ChatGLMSeq2Seq,
+    "bloom": BLoomSeq2Seq,
+    "qwen": QwenSeq2Seq,
+    "baichuan": BaichuanSeq2Seq,
+}
+
+CLASSIFY = {
+    "llama": LLAMAClassify,
+    "llama2": LLAMAClassify,
+    "bloom": BLoomClassify,
+}
+
+
+def decode_profile(args, profile):
+    """
+    tokens/s and peak MB of one decoding profile, run in a fresh process by bench_decoding.
+    """
+    llm = SEQ2SEQ[args.model_type]()
+    llm.model_type = args.model_type
+    llm.base_model = args.model_path
+    llm.adapter_weights = args.adapter_weights
+    llm.max_new_tokens = args.max_new_tokens
+    llm.output_scores = args.output_scores
+    llm.decoding_profile = profile
+
+    model = llm.load_eval_model(compile=False)
+    inputs = llm.tokenizer(llm.generate_eval_prompt(args.instruction), return_tensors="pt")
+    input_ids = inputs["input_ids"].to(llm.device)
+
+    rss_peak = None
+    if llm.device == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+    else:
+        rss_peak = RSSPeak()
+
+    new_tokens = 0
+    start = time.time()
+    for _ in range(args.rounds):
+        with torch.no_grad():
+            generation_output = model.generate(
+                input_ids=input_ids,
+                generation_config=llm.generation_config(),
+                return_dict_in_generate=True,
+                output_scores=llm.output_scores,
+                max_new_tokens=llm.max_new_tokens,
+            )
+        new_tokens += generation_output.sequences.shape[1] - input_ids.shape[1]
+    elapsed = time.time() - start
+
+    return new_tokens / elapsed, peak_memory_mb(llm.device) if rss_peak is None else rss_peak.peak_mb()
+
+
+def bench_decoding(args):
+    # a fresh process per profile, the rss a profile leaves behind must not count as the peak of the next one
+    print("{:<12} {:>12} {:>14}".format("profile", "tokens/s", "peak MB"))
+    for profile in args.profiles:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            tokens_per_second, peak_mb = executor.submit(decode_profile, args, profile).result()
+
+        print("{:<12} {:>12.1f} {:>14.1f}".format(profile, tokens_per_second, peak_mb))
+
+
+def bench_tokenize(args):
+    from transformers import AutoTokenizer
+
+    llm = (SEQ2SEQ if args.task_type == "seq2seq" else CLASSIFY)[args.model_type]()
+    llm.model_type = args.model_type
+    llm.data_path = args.data
+    llm.labels = json.loads(args.labels)
+    llm.cutoff_len = args.cutoff_len
+    llm.num_proc = args.num_proc
+    llm.tokenizer = AutoTokenizer.from_pretrained(args.model_path, trust_remote_code=True)
+    data = llm.load_train_data(False, None)["train"]
+    if args.rows:
+        data = data.select(range(min(args.rows, data.num_rows)))
+
+    start = time.time()
+    per_example = data.map(llm.tokenize_prompt, load_from_cache_file=False)
+    per_example_time = time.time() - start
+
+    start = time.time()
+    batched = data.map(
+        llm.tokenize_batch,
+        batched=True,
+        batch_size=llm.tokenize_batch_size,
+        num_proc=llm.num_proc if llm.num_proc > 1 else None,
+        load_from_cache_file=False,
+    )
+    batched_time = time.time() - start
+
+    same = all(per_example[column] == batched[column] for column in ("input_ids", "labels"))
+    print("per example: {:>10.1f} rows/s".format(data.num_rows / per_example_time))
+    print("batched x{}: {:>10.1f} rows/s".format(llm.num_proc, data.num_rows / batched_time))
+    print("same input_ids/labels: {}".format(same))
+
+
+def scan_mask_spans(labels, offsets, spans):
+    # the per-span scan over all offsets that tokenize_prompt used before common.masking,
+    # tests/test_masking.py checks mask_spans against it
+    for start_pos, end_pos in spans:
+        start_idx = None
+        end_idx = None
+        for i, (start, end) in enumerate(offsets):
+            if start <= start_pos < end:
+                start_idx = i
+            if start <= end_pos < end:
+                end_idx = i
+        if start_idx is not None and end_idx is not None:
+            for i in range(start_idx, end_idx - 1):
+                labels[i] = IGNORE_INDEX
+
+    return labels
+
+
+def bench_masking(args):
+    tokenizer = None
+    if args.model_path:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.model_path, trust_remote_code=True)
+
+    rng = random.Random(42)
+    words = ["the", "model", "answers", "a", "question", "about", "data", ",", "and", "then", "asks", "again", "."]
+    samples = []
+    for _ in range(args.samples):
+        turns = "".join(
+            "### {}: {}\n".format("Human" if i % 2 == 0 else "Assistant", " ".join(rng.choice(words) for _ in range(args.turn_words)))
+            for i in range(args.turns)
+        )
+        prompt = PROMPT_DICT['prompt_multirun_input'].format(instruction=turns, output="")
+        prompt = re.sub(r'(?<!\n)\n### ', '\n</s>### ', prompt) + '</s>'
+        if tokenizer is not None:
+            tokenized = tokenizer(prompt, return_offsets_mapping=True)
+            input_ids, offsets = tokenized["input_ids"], tokenized["offset_mapping"]
+        else:
+            # whitespace "tokens" are enough to time the masking itself
+            offsets = [match.span() for match in re.finditer(r"\s*\S+", prompt)]
+            input_ids = list(range(len(offsets)))
+        spans = [match.span() for match in re.finditer(r'### (?!Assistant:)(.*?)</s>', prompt, re.DOTALL)]
+        samples.append((input_ids, offsets, spans))
+
+    timings = {}
+    for name, func in (("scan", scan_mask_spans), ("mask_spans", mask_spans)):
+        start = time.time()
+        for input_ids, offsets, spans in samples:
+            func(list(input_ids), offsets, spans)
+        timings[name] = time.time() - start
+
+    tokens = sum(len(input_ids) for input_ids, _, _ in samples) / len(samples)
+    print("{} dialogues, {} turns, {:.0f} tokens on average".format(len(samples), args.turns, tokens))
+    for name, elapsed in timings.items():
+        print("{:<12} {:>10.1f} dialogues/s".format(name, len(samples) / elapsed))
+
+
+class LoopChatGLMCollator(ChatGLMCollator):
+    # the per-row loops ChatGLMCollator used before it was vectorized, one host sync per .item()
+
+    def get_attention_masks_v1(self, input_ids, device):
+        batch_size, seq_length = input_ids.size()
+        attention_mask = torch.ones((batch_size, seq_length, seq_length), device=device)
+        attention_mask.tril_()
+        for i, seq in enumerate(input_ids):
+            attention_mask[i, :, :(seq == self.tokenizer.bos_token_id).nonzero()[0].item()] = 1
+            attention_mask[i, :, :(seq != self.tokenizer.pad_token_id).nonzero()[0].item()] = 0
+        attention_mask.unsqueeze_(1)
+
+        return (attention_mask < 0.5).bool()
+
+    def get_position_ids_v1(self, input_ids, device):
+        batch_size, seq_length = input_ids.size()
+        mask = self.model.config.mask_token_id
+        gmask = self.model.config.gmask_token_id
+        position_ids = torch.zeros((batch_size, seq_length), dtype=torch.long, device=device)
+        block_position_ids = torch.zeros((batch_size, seq_length), dtype=torch.long, device=device)
+        for i, seq in enumerate(input_ids):
+            mask_token = gmask if gmask in seq else mask
+            context_length = (seq == self.tokenizer.bos_token_id).nonzero()[0].item()
+            padding_length = (seq != self.tokenizer.pad_token_id).nonzero()[0].item()
+            position_ids[i, padding_length:] = torch.arange(seq_length - padding_length, dtype=torch.long, device=device)
+            if self.model.position_encoding_2d or (mask_token != gmask):
+                position_ids[i, context_length:] = (seq == mask_token).nonzero()[0].item() - padding_length
+            block_position_ids[i, context_length:] = torch.arange(seq_length - context_length, dtype=torch.long, device=device) + 1
+        if self.model.position_encoding_2d:
+            position_ids = torch.stack((position_ids, block_position_ids), dim=1)
+
+        return position_ids
+
+    def get_attention_masks_v2(self, input_ids, device):
+        batch_size, seq_length = input_ids.size()
+        attention_mask = torch.ones((batch_size, seq_length), device=device)
+        for i, seq in enumerate(input_ids):
+            attention_mask[i, :(seq != self.tokenizer.pad_token_id).nonzero()[0].item()] = 0
+
+        return attention_mask
+
+    def get_position_ids_v2(self, input_ids, device):
+        batch_size, seq_length = input_ids.size()
+        position_ids = torch.zeros((batch_size, seq_length), dtype=torch.long, device=device)
+        for i, seq in enumerate(input_ids):
+            padding_length = (seq != self.tokenizer.pad_token_id).nonzero()[0].item()
+            position_ids[i, padding_length:] = torch.arange(seq_length - padding_length, dtype=torch.long, device=device)
+
+        return position_ids
+
+
+def bench_collator(args):
+    # token ids of chatglm-6b, no model or tokenizer files needed
+    pad, bos, mask, gmask = 3, 130004, 130000, 130001
+    tokenizer = types.SimpleNamespace(pad_token_id=pad, bos_token_id=bos)
+    model = types.SimpleNamespace(
+        config=types.SimpleNamespace(mask_token_id=mask, gmask_token_id=gmask),
+        position_encoding_2d=not args.v2
+    )
+
+    rng = random.Random(42)
+    batches = []
+    for _ in range(args.batches):
+        features = []
+        for _ in range(args.batch_size):
+            context_len = rng.randint(2, args.max_len // 2)
+            context = [rng.randint(5, 130000 - 1) for _ in range(context_len - 1)] + [gmask, bos]
+            response = [rng.randint(5, 130000 - 1) for _ in range(rng.randint(1, args.max_len // 2))]
+            features.append({"input_ids": context + response, "labels": [pad] * len(context) + response})
+        batches.append(features)
+
+    print("{:<12} {:>10} {:>14}".format("collator", "batches/s", "batch MB"))
+    outputs = {}
+    for name, collator_class, compact_masks in (
+        ("loop", LoopChatGLMCollator, False),
+        ("vectorized", ChatGLMCollator, False),
+        ("compact", ChatGLMCollator, True),
+    ):
+        collator = collator_class(tokenizer, model=model, use_v2=args.v2, compact_masks=compact_masks)
+        start = time.time()
+        outputs[name] = [collator(features) for features in batches]
+        elapsed = time.time() - start
+        # what the dataloader holds and copies to the device for every batch
+        batch_mb = max(sum(tensor.nbytes for tensor in batch.values()) for batch in outputs[name]) / 2 ** 20
+        print("{:<12} {:>10.1f} {:>14.1f}".format(name, len(batches) / elapsed, batch_mb))
+        outputs[name] = [collator.expand_inputs(dict(batch)) for batch in outputs[name]]
+
+    same = all(
+        all(torch.equal(loop[key], other[key]) for key in loop)
+        for name in ("vectorized", "compact")
+        for loop, other in zip(outputs["loop"], outputs[name])
+    )
+    print("same outputs: {}".format(same))
+
+
+def bench_cpu_train(args):
+    llm = SEQ2SEQ[args.model_type]()
+    llm.model_type = args.model_type
+    llm.base_model = args.model_path
+    llm.adapter = "lora"
+    llm.lora_target_modules = ["q_proj", "v_proj"] if args.model_type.startswith("llama") else ["query_key_value"]
+    llm.device = "cpu"
+    llm.cpu_threads = args.cpu_threads
+    llm.auto_device()
+
+    model, llm.tokenizer = llm.get_model_tokenizer()
+    model = llm.load_adapter_config(model)
+    model.train()
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=llm.learning_rate)
+    input_ids = torch.randint(100, len(llm.tokenizer), (args.batch_size, args.seq_len))
+
+    modes = [("fp32", False)]
+    if llm.is_bf16:
+        modes.append(("bf16", True))
+    else:
+        print("No native bf16 on this cpu, fp32 only")
+
+    print("{:<6} {:>12} {:>10}".format("mode", "tokens/s", "speed-up"))
+    baseline = None
+    for mode, bf16 in modes:
+        for step in range(args.warmup + args.steps):
+            if step == args.warmup:
+                start = time.time()
+            with torch.autocast("cpu", dtype=torch.bfloat16, enabled=bf16):
+                loss = model(input_ids=input_ids, labels=input_ids).loss
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+        tokens_per_sec = args.steps * input_ids.numel() / (time.time() - start)
+        baseline = baseline or tokens_per_sec
+        print("{:<6} {:>12.1f} {:>9.2f}x".format(mode, tokens_per_sec, tokens_per_sec / baseline))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks for all.')
+    subparsers = parser.add_subparsers(dest="bench", required=True)
+
+    # decoding
+    decoding = subparsers.add_parser("decoding", help="tokens/sec and peak memory of every decoding profile, each in a fresh process")
+    decoding.add_argument('--model_type', default="llama", choices=list(SEQ2SEQ))
+    decoding.add_argument('--model_path', default="LLMs/open-llama/openllama-3b", type=str)
+    decoding.add_argument('--adapter_weights', default="None", type=str, help="The DIR of adapter weights")
+    decoding.add_argument('--instruction', default="Who are you?", type=str)
+    decoding.add_argument('--max_new_tokens', default=128, type=int)
+    decoding.add_argument('--rounds', default=5, type=int)
+    decoding.add_argument('--profiles', nargs='+', default=list(DECODING_PROFILES), choices=list(DECODING_PROFILES))
+    decoding.add_argument('--output_scores', action="store_true")
+    decoding.set_defaults(func=bench_decoding)
+
+    # tokenize
+    tokenize = subparsers.add_parser("tokenize", help="rows/sec of per-example vs batched multi-process tokenization")
+    tokenize.add_argument('--data', default="data/train/", type=str)
+    tokenize.add_argument('--model_type', default="llama", choices=list(SEQ2SEQ))
+    tokenize.add_argument('--task_type', default="seq2seq", choices=['seq2seq', 'classify'])
+    tokenize.add_argument('--labels', default="[\"0\", \"1\"]")
+    tokenize.add_argument('--model_path', default="LLMs/open-llama/openllama-3b", type=str)
+    tokenize.add_argument('--cutoff_len', default=512, type=int)
+    tokenize.add_argument('--num_proc', default=4, type=int)
+    tokenize.add_argument('--rows', default=None, type=int, help="Only use the first rows of the data")
+    tokenize.set_defaults(func=bench_tokenize)
+
+    # masking
+    masking = subparsers.add_parser("masking", help="multi-round label masking, per-span scan vs common.masking")
+    masking.add_argument('--model_path', default=None, type=str, help="Tokenizer to get offsets from, whitespace tokens if not set")
+    masking.add_argument('--samples', default=20, type=int)
+    masking.add_argument('--turns', default=200, type=int)
+    masking.add_argument('--turn_words', default=30, type=int)
+    masking.set_defaults(func=bench_masking)
+
+    # collator
+    collator = subparsers.add_parser("collator", help="ChatGLMCollator masks and position ids, per-row loops vs vectorized, on CPU")
+    collator.add_argument('--v2', action="store_true", help="chatglm2 instead of chatglm")
+    collator.add_argument('--batches', default=20, type=int)
+    collator.add_argument('--batch_size', default=4, type=int)
+    collator.add_argument('--max_len', default=2048, type=int, help="Longest sample, i.e. cutoff_len")
+    collator.set_defaults(func=bench_collator)
+
+    # cpu_train
+    cpu_train = subparsers.add_parser("cpu_train", help="lora train steps/sec on cpu, bf16 autocast vs the fp32 baseline")
+    cpu_train.add_argument('--model_type', default="bloom", choices=["llama", "llama2", "bloom"])
+    cpu_train.add_argument('--model_path', default="LLMs/bloom/bloomz-560m", type=str)
+    cpu_train.add_argument('--cpu_threads', default=None, type=int)
+    cpu_train.add_argument('--batch_size', default=4, type=int)
+    cpu_train.add_argument('--seq_len', default=256, type=int)
+    cpu_train.add_argument('--warmup', default=2, type=int)
+    cpu_train.add_argument('--steps', default=10, type=int)
+    cpu_train.set_defaults(func=bench_cpu_train)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -5,3 +5,10 @@ IGNORE_INDEX = -100
 # auth
 WEB_USERNAME = os.getenv("WEB_USERNAME")
 WEB_PASSWORD = os.getenv("WEB_PASSWORD")
+
+# named generate settings, temperature/top_p/top_k come from the command line
+DECODING_PROFILES = {
+    "beam": dict(num_beams=4, do_sample=True, no_repeat_ngram_size=6, repetition_penalty=1.8),
+    "sampling": dict(num_beams=1, do_sample=True, repetition_penalty=1.1),
+    "greedy-fast": dict(num_beams=1, do_sample=False),
+}
@@ -0,0 +1,54 @@
+import random
+
+
+def length_sorted_batches(lengths, batch_size=None, max_tokens=None):
+    """
+    Group sample indices into batches of similar length.
+
+    Indices are sorted by length (longest first, so an OOM shows up on the first batch) and cut into
+    batches of at most `batch_size` samples and, when `max_tokens` is set, at most `max_tokens` padded tokens.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+
+    batches = []
+    batch = []
+    longest = 0
+    for i in order:
+        if batch:
+            too_many = batch_size and len(batch) >= batch_size
+            too_long = max_tokens and max(longest, lengths[i]) * (len(batch) + 1) > max_tokens
+            if too_many or too_long:
+                batches.append(batch)
+                batch = []
+                longest = 0
+        batch.append(i)
+        longest = max(longest, lengths[i])
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+class TokenBudgetBatchSampler:
+    """
+    Batch sampler whose batches hold at most `max_tokens` padded tokens instead of a fixed number of samples.
+
+    Batches are cut once from the length-sorted samples, so their count (and the schedule built on it) is fixed,
+    long samples go in small batches and short ones in large batches. Only the order of the batches is shuffled,
+    with a new seed each epoch.
+    """
+
+    def __init__(self, lengths, max_tokens, seed=42):
+        self.batches = length_sorted_batches(lengths, max_tokens=max_tokens)
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        order = list(range(len(self.batches)))
+        random.Random(self.seed + self.epoch).shuffle(order)
+        self.epoch += 1
+        for i in order:
+            yield self.batches[i]
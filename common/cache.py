@@ -0,0 +1,54 @@
+import os
+import time
+import sqlite3
+
+
+class ResponseCache:
+    r"""
+    Size-bounded LRU memo of generated responses, kept in a SQLite file so it survives between runs.
+    """
+
+    def __init__(self, path, max_entries=100000):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("create table if not exists responses (key text primary key, response text, last_access real)")
+        self.conn.execute("create index if not exists responses_last_access on responses (last_access)")
+        self.conn.commit()
+        self.size = self.conn.execute("select count(*) from responses").fetchone()[0]
+
+    def get(self, key):
+        row = self.conn.execute("select response from responses where key=?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.conn.execute("update responses set last_access=? where key=?", (time.time(), key))
+        self.conn.commit()
+
+        return row[0]
+
+    def put(self, key, response):
+        cur = self.conn.execute("update responses set response=?, last_access=? where key=?", (response, time.time(), key))
+        if cur.rowcount == 0:
+            self.conn.execute("insert into responses (key, response, last_access) values (?, ?, ?)", (key, response, time.time()))
+            self.size += 1
+        if self.size > self.max_entries:
+            # evict the least recently used entries
+            self.conn.execute(
+                "delete from responses where key in (select key from responses order by last_access limit ?)",
+                (self.size - self.max_entries,)
+            )
+            self.size = self.max_entries
+        self.conn.commit()
+
+    def stats(self):
+        return "Response cache: {} hits, {} misses, {} entries".format(self.hits, self.misses, self.size)
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+import platform
+import resource
+import threading
+
+import psutil
+import torch
+
+
+def cpu_count():
+    """
+    CPUs this process may run on, which is less than os.cpu_count() under taskset or a container cpuset.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def cpu_supports_bf16():
+    """
+    Whether the CPU computes bf16 natively (AVX512-BF16 / AMX on x86, BF16 on arm64), otherwise it is only emulated
+    and slower than fp32.
+    """
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read().split()
+    except OSError:
+        # macOS on apple silicon
+        return platform.system() == "Darwin" and platform.machine() == "arm64"
+
+    return any(flag in flags for flag in ("avx512_bf16", "amx_bf16", "bf16"))
+
+
+def peak_memory_mb(device):
+    """
+    Peak allocated memory of the device, or peak RSS of the process when not on cuda.
+    """
+    if device == "cuda":
+        return torch.cuda.max_memory_allocated() / 2 ** 20
+    # process peak, ru_maxrss is in KB on linux and in bytes on mac
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == "darwin" else rss / 2 ** 10
+
+
+class RSSPeak:
+    r"""
+    Peak RSS of the process since the last reset, sampled every interval seconds by a daemon thread.
+
+    ru_maxrss cannot be reset, it only ever gives the peak of the whole run. Peaks shorter than interval may be
+    missed.
+    """
+
+    def __init__(self, interval=0.01):
+        self.process = psutil.Process()
+        self.interval = interval
+        self.peak = self.process.memory_info().rss
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+    def sample(self):
+        while True:
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            time.sleep(self.interval)
+
+    def peak_mb(self):
+        return max(self.peak, self.process.memory_info().rss) / 2 ** 20
+
+    def reset(self):
+        self.peak = self.process.memory_info().rss
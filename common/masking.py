@@ -0,0 +1,33 @@
+from common.base import IGNORE_INDEX
+
+
+def token_cover(offsets, length):
+    """
+    For every char position below length, the index of the last token whose (start, end) offsets cover it, -1 for none.
+    """
+    cover = [-1] * length
+    for i, (start, end) in enumerate(offsets):
+        if end > start:
+            cover[start:end] = [i] * (end - start)
+
+    return cover
+
+
+def mask_spans(labels, offsets, spans):
+    """
+    Set the labels of every (start_pos, end_pos) char span to IGNORE_INDEX, in place.
+
+    A span masks from the token covering start_pos up to two before the token covering end_pos, and nothing
+    when either position is not covered, exactly like scanning all offsets per span. The cover of each char
+    is built once, so the cost is linear in tokens + chars instead of tokens x spans.
+    """
+    length = max([end for _, end in offsets] + [end_pos + 1 for _, end_pos in spans] + [0])
+    cover = token_cover(offsets, length)
+
+    for start_pos, end_pos in spans:
+        start_idx = cover[start_pos]
+        end_idx = cover[end_pos]
+        if start_idx >= 0 and end_idx >= 0 and end_idx - 1 > start_idx:
+            labels[start_idx:end_idx - 1] = [IGNORE_INDEX] * (end_idx - 1 - start_idx)
+
+    return labels
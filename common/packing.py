@@ -0,0 +1,69 @@
+import torch
+
+from common.base import IGNORE_INDEX
+
+
+def pack_examples(batch, cutoff_len, pad_token_id):
+    """
+    Batched map function concatenating tokenized examples into windows of exactly cutoff_len tokens.
+
+    Examples are packed greedily in order. Inside a window, attention_mask holds the 1-based index of the example
+    each token belongs to (0 for padding) and position_ids restart at 0 for every example. The first label of
+    every example is ignored, otherwise the last token of the previous example would be trained to predict it.
+    """
+    packed = {"input_ids": [], "attention_mask": [], "position_ids": [], "labels": []}
+    window = {key: [] for key in packed}
+    segment = 0
+
+    def flush():
+        pad_len = cutoff_len - len(window["input_ids"])
+        packed["input_ids"].append(window["input_ids"] + [pad_token_id] * pad_len)
+        packed["attention_mask"].append(window["attention_mask"] + [0] * pad_len)
+        packed["position_ids"].append(window["position_ids"] + [0] * pad_len)
+        packed["labels"].append(window["labels"] + [IGNORE_INDEX] * pad_len)
+        for key in window:
+            window[key] = []
+
+    for input_ids, labels in zip(batch["input_ids"], batch["labels"]):
+        input_ids = input_ids[:cutoff_len]
+        labels = labels[:cutoff_len]
+        if not input_ids:
+            continue
+        if len(window["input_ids"]) + len(input_ids) > cutoff_len:
+            flush()
+            segment = 0
+        segment += 1
+        window["input_ids"] += input_ids
+        window["attention_mask"] += [segment] * len(input_ids)
+        window["position_ids"] += list(range(len(input_ids)))
+        window["labels"] += [IGNORE_INDEX] + labels[1:]
+    if window["input_ids"]:
+        flush()
+
+    return packed
+
+
+def padding_ratio(lengths, batch_size, padded_len=None):
+    """
+    Share of pad tokens when lengths are batched in order, padded to the longest of each batch or to padded_len.
+    """
+    total = 0
+    for i in range(0, len(lengths), batch_size):
+        batch = lengths[i:i + batch_size]
+        total += (padded_len or max(batch)) * len(batch)
+
+    return 1 - sum(lengths) / total if total else 0.0
+
+
+def segment_attention_mask(segment_ids, dtype):
+    """
+    4D additive mask (bsz, 1, len, len) letting each token attend causally within its own example only.
+    """
+    causal = torch.tril(torch.ones(segment_ids.shape[1], segment_ids.shape[1], dtype=torch.bool, device=segment_ids.device))
+    same = segment_ids[:, :, None] == segment_ids[:, None, :]
+    allowed = same & causal[None] & (segment_ids[:, None, :] > 0)
+
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=segment_ids.device)
+    mask = mask.masked_fill(~allowed, torch.finfo(dtype).min)
+
+    return mask[:, None]
@@ -0,0 +1,51 @@
+from transformers import LogitsProcessor
+
+from common.prompt import STOP_MARKERS
+
+
+def cut_stop_marker(text, markers=STOP_MARKERS):
+    """
+    Cut text at the first stop marker, returns the text before it and whether one was found.
+    """
+    positions = [text.find(marker) for marker in markers if marker in text]
+    if not positions:
+        return text, False
+
+    return text[:min(positions)], True
+
+
+def pending_marker_len(text, markers=STOP_MARKERS):
+    """
+    Length of the longest suffix of text that may still grow into a stop marker, streams hold it back.
+    """
+    for n in range(min(len(text), max(len(marker) for marker in markers) - 1), 0, -1):
+        if any(marker.startswith(text[-n:]) for marker in markers):
+            return n
+
+    return 0
+
+
+class StopMarkersLogitsProcessor(LogitsProcessor):
+    r"""
+    Ends every sequence of a batch on its own as soon as its generated tail contains a stop marker.
+
+    A stopping criteria can only stop the whole batch, so the rows that hit a marker are forced to emit eos instead,
+    which finishes them in greedy, sample and beam search alike while the other rows keep going.
+    """
+
+    def __init__(self, tokenizer, prompt_len, eos_token_id, markers=STOP_MARKERS):
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+        self.eos_token_id = eos_token_id
+        self.markers = markers
+        # enough tokens to spell the longest marker even at one character per token
+        self.window = max(len(marker) for marker in markers) + 1
+
+    def __call__(self, input_ids, scores):
+        start = max(self.prompt_len, input_ids.shape[1] - self.window)
+        for i, tail in enumerate(input_ids[:, start:].tolist()):
+            if cut_stop_marker(self.tokenizer.decode(tail, skip_special_tokens=True), self.markers)[1]:
+                scores[i, :] = -float("inf")
+                scores[i, self.eos_token_id] = 0
+
+        return scores
@@ -0,0 +1,286 @@
+import os
+import re
+import copy
+import json
+import time
+import random
+import shutil
+import threading
+
+import numpy as np
+import torch
+
+from peft import get_peft_model_state_dict
+from safetensors.torch import save_file
+from transformers import TrainerCallback
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+
+from common.device import RSSPeak, peak_memory_mb
+
+# the directories transformers.trainer_utils.get_last_checkpoint picks the latest from
+CHECKPOINT_DIR = re.compile(r"^" + PREFIX_CHECKPOINT_DIR + r"-(\d+)$")
+
+
+class ThroughputCallback(TrainerCallback):
+    r"""
+    Records where training time goes, one window per logging step.
+
+    LLMTrainer reports every micro batch through batch_start/batch_end: its samples, tokens and padding, the wait
+    for the data loader before it and the forward/backward time of it. The optimizer step, logging and evaluation
+    count as other time. Peak memory is per window too. Each window is appended to throughput.jsonl in output_dir
+    and throughput.prom is rewritten in the Prometheus text format, for a textfile collector to pick up. Only the
+    main process writes.
+
+    cuda kernels run async, so without synchronize part of the compute is only waited for in the next data wait
+    or optimizer step. synchronize makes the split exact at the price of a stall after every micro batch.
+    """
+
+    prefix = "superadapters_train"
+
+    def __init__(self, output_dir, pad_token_id=None, synchronize=False):
+        self.pad_token_id = pad_token_id
+        self.synchronize = synchronize
+        self.jsonl_path = os.path.join(output_dir, "throughput.jsonl")
+        self.prom_path = os.path.join(output_dir, "throughput.prom")
+        self.total_samples = 0
+        self.total_tokens = 0
+        self.rss_peak = RSSPeak()
+        self.reset_window()
+        self.last_batch_end = None
+        self.last_step_end = None
+        self.batch_started = None
+
+    def reset_window(self):
+        self.window_start = time.time()
+        self.samples = 0
+        self.tokens = 0
+        self.padded_tokens = 0
+        self.data_wait = 0.0
+        self.compute = 0.0
+        self.step_latencies = []
+        self.rss_peak.reset()
+
+    def batch_start(self, inputs):
+        now = time.time()
+        if self.last_batch_end is not None:
+            self.data_wait += now - self.last_batch_end
+        self.batch_started = now
+
+        input_ids = inputs["input_ids"]
+        attention_mask = inputs.get("attention_mask")
+        if "mask_lengths" in inputs:
+            # compact ChatGLM masks, (padding length, context length) of every row
+            tokens = input_ids.numel() - int(inputs["mask_lengths"][:, 0].sum())
+        elif attention_mask is not None and attention_mask.dim() == 2:
+            tokens = int((attention_mask != 0).sum())
+        elif self.pad_token_id is not None:
+            tokens = int((input_ids != self.pad_token_id).sum())
+        else:
+            tokens = input_ids.numel()
+        self.samples += input_ids.shape[0]
+        self.tokens += tokens
+        self.padded_tokens += input_ids.numel()
+        self.total_samples += input_ids.shape[0]
+        self.total_tokens += tokens
+
+    def batch_end(self):
+        if self.synchronize and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.last_batch_end = time.time()
+        self.compute += self.last_batch_end - self.batch_started
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.reset_window()
+        self.last_step_end = time.time()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        now = time.time()
+        self.step_latencies.append(now - self.last_step_end)
+        self.last_step_end = now
+        # the optimizer step since the last batch is not data wait
+        self.last_batch_end = now
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        # the pause before the next batch is evaluation, not data loading
+        self.last_batch_end = None
+
+    def on_save(self, args, state, control, **kwargs):
+        self.last_batch_end = None
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if self.step_latencies:
+            self.write(state)
+        if self.last_batch_end is not None:
+            self.last_batch_end = time.time()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self.step_latencies:
+            self.write(state)
+
+    def percentile(self, q):
+        latencies = sorted(self.step_latencies)
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def write(self, state):
+        elapsed = max(time.time() - self.window_start, 1e-9)
+        record = {
+            "time": time.time(),
+            "step": state.global_step,
+            "epoch": state.epoch,
+            "tokens_per_sec": self.tokens / elapsed,
+            "samples_per_sec": self.samples / elapsed,
+            "padding_ratio": 1 - self.tokens / self.padded_tokens if self.padded_tokens else 0.0,
+            "data_wait_sec": self.data_wait,
+            "compute_sec": self.compute,
+            # optimizer steps, logging, evaluation
+            "other_sec": max(0.0, elapsed - self.data_wait - self.compute),
+            "step_latency_p50": self.percentile(0.5),
+            "step_latency_p90": self.percentile(0.9),
+            "step_latency_p99": self.percentile(0.99),
+            "peak_rss_mb": self.rss_peak.peak_mb(),
+            "peak_device_mb": peak_memory_mb("cuda") if torch.cuda.is_available() else None,
+        }
+        self.reset_window()
+        if not state.is_world_process_zero:
+            return
+
+        with open(self.jsonl_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+        metrics = [
+            ("step", "Optimizer steps done.", "counter", record["step"]),
+            ("tokens_per_second", "Non-padding tokens per second over the last window.", "gauge", record["tokens_per_sec"]),
+            ("samples_per_second", "Samples per second over the last window.", "gauge", record["samples_per_sec"]),
+            ("padding_ratio", "Share of pad tokens in the batches of the last window.", "gauge", record["padding_ratio"]),
+            ("data_wait_seconds", "Time spent waiting for batches in the last window.", "gauge", record["data_wait_sec"]),
+            ("compute_seconds", "Forward and backward time in the last window.", "gauge", record["compute_sec"]),
+            ("peak_rss_bytes", "Peak resident memory of the process over the last window.", "gauge", record["peak_rss_mb"] * 2 ** 20),
+        ]
+        if record["peak_device_mb"] is not None:
+            metrics.append(("peak_device_memory_bytes", "Peak allocated cuda memory.", "gauge", record["peak_device_mb"] * 2 ** 20))
+
+        lines = []
+        for name, help, kind, value in metrics:
+            lines += [
+                "# HELP {}_{} {}".format(self.prefix, name, help),
+                "# TYPE {}_{} {}".format(self.prefix, name, kind),
+                "{}_{} {}".format(self.prefix, name, value),
+            ]
+        lines += [
+            "# HELP {}_step_latency_seconds Optimizer step latency over the last window.".format(self.prefix),
+            "# TYPE {}_step_latency_seconds summary".format(self.prefix),
+        ]
+        for quantile, key in (("0.5", "step_latency_p50"), ("0.9", "step_latency_p90"), ("0.99", "step_latency_p99")):
+            lines.append('{}_step_latency_seconds{{quantile="{}"}} {}'.format(self.prefix, quantile, record[key]))
+
+        # write aside and rename, a scraper must never read half a file
+        tmp_path = self.prom_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.prom_path)
+
+
+def to_cpu(obj):
+    """
+    Copy of a (nested) state dict with every tensor copied to cpu.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return copy.deepcopy(obj)
+
+
+class AsyncCheckpointCallback(TrainerCallback):
+    r"""
+    Saves the adapter every save_steps optimizer steps and/or every save_minutes of wall-clock time, without
+    stalling training.
+
+    The adapter weights, the optimizer and lr scheduler state, the trainer state and the rng states are copied to
+    cpu on the training thread, which is cheap next to a full checkpoint as only the adapter has optimizer state.
+    A background thread writes them to checkpoint-N in the name and layout of a trainer checkpoint
+    (adapter_model.safetensors, adapter_config.json, optimizer.pt, scheduler.pt, trainer_state.json and
+    rng_state.pth), so resume_from_checkpoint, given this dir or just True, continues from the same step. A save coming due while the previous
+    one is still writing waits for the next step. The newest args.save_total_limit checkpoints are kept. Only the
+    main process writes.
+    """
+
+    def __init__(self, output_dir, save_steps=None, save_minutes=None):
+        self.output_dir = output_dir
+        self.save_steps = save_steps
+        self.save_seconds = save_minutes * 60 if save_minutes else None
+        self.last_save = time.time()
+        self.thread = None
+
+    def due(self, state):
+        if self.save_steps and state.global_step % self.save_steps == 0:
+            return True
+
+        return self.save_seconds is not None and time.time() - self.last_save >= self.save_seconds
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.last_save = time.time()
+
+    def on_step_end(self, args, state, control, model=None, optimizer=None, lr_scheduler=None, **kwargs):
+        if not state.is_world_process_zero or not self.due(state):
+            return
+        if self.thread is not None and self.thread.is_alive():
+            print("Warning! Checkpoint of a previous step is still being written, skip step {}".format(state.global_step))
+            return
+
+        weights = {
+            name: tensor.detach().to("cpu", copy=True).contiguous()
+            for name, tensor in get_peft_model_state_dict(model).items()
+        }
+        peft_config = model.peft_config[model.active_adapter]
+        # the optimizer and scheduler keep updating in place while the thread writes, so copy them here
+        optimizer_state = to_cpu(optimizer.state_dict()) if optimizer is not None else None
+        scheduler_state = copy.deepcopy(lr_scheduler.state_dict()) if lr_scheduler is not None else None
+        rng_state = {
+            "python": random.getstate(),
+            "numpy": np.random.get_state(),
+            "cpu": torch.random.get_rng_state(),
+        }
+        if torch.cuda.is_available():
+            rng_state["cuda"] = torch.cuda.random.get_rng_state_all()
+        self.last_save = time.time()
+        self.thread = threading.Thread(
+            target=self.write,
+            args=(
+                weights, peft_config, optimizer_state, scheduler_state, copy.deepcopy(state), rng_state,
+                args.save_total_limit
+            ),
+            daemon=True
+        )
+        self.thread.start()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self.thread is not None:
+            self.thread.join()
+
+    def write(self, weights, peft_config, optimizer_state, scheduler_state, state, rng_state, save_total_limit):
+        checkpoint_dir = os.path.join(self.output_dir, "{}-{}".format(PREFIX_CHECKPOINT_DIR, state.global_step))
+        # write aside and rename, a crash must never leave a half written checkpoint to resume from
+        tmp_dir = checkpoint_dir + ".tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        save_file(weights, os.path.join(tmp_dir, "adapter_model.safetensors"), metadata={"format": "pt"})
+        peft_config.save_pretrained(tmp_dir)
+        if optimizer_state is not None:
+            torch.save(optimizer_state, os.path.join(tmp_dir, "optimizer.pt"))
+        if scheduler_state is not None:
+            torch.save(scheduler_state, os.path.join(tmp_dir, "scheduler.pt"))
+        torch.save(rng_state, os.path.join(tmp_dir, "rng_state.pth"))
+        state.save_to_json(os.path.join(tmp_dir, "trainer_state.json"))
+        if os.path.exists(checkpoint_dir):
+            shutil.rmtree(checkpoint_dir)
+        os.replace(tmp_dir, checkpoint_dir)
+        print("Saved adapter checkpoint {}".format(checkpoint_dir))
+
+        if save_total_limit:
+            steps = sorted(
+                int(match.group(1)) for match in map(CHECKPOINT_DIR.match, os.listdir(self.output_dir)) if match
+            )
+            for old in steps[:-save_total_limit]:
+                shutil.rmtree(os.path.join(self.output_dir, "{}-{}".format(PREFIX_CHECKPOINT_DIR, old)), ignore_errors=True)
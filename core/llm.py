@@ -1,7 +1,14 @@
 import os
+import gc
 import sys
+import csv
 import json
+import time
+import shutil
+import hashlib
+import inspect
 import torch
+import transformers
 from peft import (
     AdaLoraConfig,
     PrefixTuningConfig,
@@ -10,10 +17,27 @@ from peft import (
     LoraConfig,
     TaskType,
     get_peft_model,
+    PeftModel,
+    PromptLearningConfig,
+    set_peft_model_state_dict,
 )
+from safetensors.torch import load_file
 
 from typing import List
-from datasets import load_dataset, Dataset, DatasetDict
+from datasets import load_dataset, load_from_disk, Dataset, DatasetDict, IterableDataset, Features, Value
+from datasets.arrow_writer import ArrowWriter
+from threading import Thread
+from transformers import GenerationConfig, LogitsProcessorList, TextIteratorStreamer
+
+from common.base import DECODING_PROFILES, IGNORE_INDEX
+from common.device import cpu_count, cpu_supports_bf16
+from common.prompt import PROMPT_DICT, STOP_MARKERS
+from common.batching import length_sorted_batches, TokenBudgetBatchSampler
+from common.masking import mask_spans
+from common.packing import pack_examples, padding_ratio
+from common.stopping import StopMarkersLogitsProcessor, cut_stop_marker, pending_marker_len
+from core.trainer import LLMTrainer
+from core.callbacks import AsyncCheckpointCallback, ThroughputCallback
 
 
 class LLM:
@@ -29,6 +53,12 @@ class LLM:
     # adapter params
     adapter: str = "prefix"
     adapter_weights: str = "output/chatglm"
+    adapters: dict = None  # name -> weights dir, all attached to one base model at inference
+    default_adapter: str = None
+    loaded_adapters: dict = None
+    adapter_hashes: dict = None
+    merge_adapter: bool = False
+    fused_dir: str = "output/fused"
 
     # lora hyperparams
     lora_r: int = 8
@@ -53,8 +83,35 @@ class LLM:
     learning_rate: float = 3e-4
     cutoff_len: int = 256
     val_set_size: float = 0.15
-    group_by_length: bool = False,  # faster, but produces an odd training loss curve
+    group_by_length: bool = False  # faster, but produces an odd training loss curve
+    max_train_batch_tokens: int = None  # batch by padded tokens instead of per_gpu_train_batch_size samples
+    streaming: bool = False  # read and tokenize the train data lazily, for corpora larger than RAM
+    shuffle_buffer_size: int = 10000
+    val_stream_size: int = 1000  # rows held out for validation when streaming
+    max_steps: int = -1
+    throughput_sync: bool = False  # exact compute vs data wait split, at the price of a cuda sync per micro batch
+    save_steps: int = None  # adapter-only checkpoints written in the background, see AsyncCheckpointCallback
+    save_minutes: float = None
+    # what a sweep config may change, everything else is fixed by the base model and the tokenized data
+    sweep_options = (
+        "adapter", "lora_r", "lora_alpha", "lora_dropout", "adalora_init_r", "adalora_tinit", "adalora_tfinal",
+        "adalora_delta_t", "num_virtual_tokens", "mapping_hidden_dim", "epochs", "learning_rate",
+        "per_gpu_train_batch_size", "gradient_accumulation_steps", "max_steps"
+    )
+    disable_bf16: bool = False  # plain fp32 on cpu even when bf16 autocast is supported
+    cpu_threads: int = None  # intra-op threads on cpu, all available cpus by default
+    dataloader_num_workers: int = None  # 2 on cpu, 0 otherwise by default
+    memory_saver: bool = False  # gradient checkpointing + chunked loss
+    loss_chunk_size: int = 1024  # label positions per lm head chunk in memory saver mode
+    support_chunked_loss: bool = True  # the lm head must be a direct child of the causal lm
+    db_chunk_size: int = 10000  # rows fetched per round trip by --fromdb
+    db_cache_dir: str = "data/cache/db"
     logging_steps: int = 10
+    num_proc: int = 1  # processes tokenizing the train data
+    tokenize_batch_size: int = 1000
+    tokenized_cache: str = "data/cache"  # tokenized train/val splits, reused while their fingerprint holds
+    packing: bool = False  # concatenate short examples into cutoff_len windows
+    support_packing: bool = False  # needs position_ids and a per-example attention mask in the model family
     load_8bit: bool = False
     add_eos_token: bool = False
     resume_from_checkpoint: str = None  # either training checkpoint or final adapter
@@ -65,6 +122,7 @@ class LLM:
     device: str = None
     use_mps_device: bool = False
     is_fp16: bool = True
+    is_bf16: bool = False
     device_map = "auto"
     world_size = int(os.environ.get("WORLD_SIZE", 1))
     ddp = world_size != 1
@@ -76,6 +134,19 @@ class LLM:
     top_p: float = 0.9
     top_k: int = 40
     max_new_tokens: int = 512
+    decoding_profile: str = "beam"
+    output_scores: bool = False
+    stop_markers: bool = True  # end a response as soon as it starts a "### ...:" section of its own
+    batch_size: int = 1
+    response_cache: str = None  # sqlite file memoizing responses across runs
+    response_cache_size: int = 100000
+    response_cache_db = None
+    prefix_cache: bool = False
+    support_prefix_cache: bool = True  # past_key_values must be batch-first to be repeated per beam
+    # batch, key seq and value seq dims of past_key_values for the server, None prefills the batch again instead
+    kv_cache_dims: tuple = (0, 2, 2)
+    prefix_kv: dict = None
+    max_batch_tokens: int = 8192
 
     def load_adapter_config(self, model):
         if self.task_type == "seq2seq":
@@ -151,6 +222,21 @@ class LLM:
             self.use_mps_device = True
             self.is_fp16 = False
             self.device_map = {"": self.device}
+        elif self.device == "cpu":
+            # fp16 autocast is gpu only, bf16 is worth it where the cpu computes it natively
+            self.is_fp16 = False
+            self.is_bf16 = not self.disable_bf16 and not self.load_8bit and cpu_supports_bf16()
+            self.device_map = {"": self.device}
+            # ranks of a cpu ddp run share the cores
+            threads = self.cpu_threads or max(1, cpu_count() // self.world_size)
+            torch.set_num_threads(threads)
+            try:
+                torch.set_num_interop_threads(min(2, threads))
+            except RuntimeError:
+                pass  # can only be set before the first inter-op parallel work, i.e. on the first call
+            if self.dataloader_num_workers is None:
+                self.dataloader_num_workers = 2
+            print("Running on cpu with {} threads, {}".format(threads, "bf16 autocast" if self.is_bf16 else "fp32"))
         else:
             if self.load_8bit:
                 self.is_fp16 = False
@@ -159,31 +245,573 @@ class LLM:
     def load_train_data(self, fromdb, s_iteration):
         data = None
         if fromdb:
-            train_data_set = []
+            train_data = self.load_db_train_data(s_iteration)
+            if self.streaming:
+                train_data = train_data.to_iterable_dataset()
+            data = DatasetDict({"train": train_data})
+        elif self.data_path:
+            if self.data_path.endswith(".json") or self.data_path.endswith(".jsonl"):
+                data = load_dataset("json", data_files=self.data_path, streaming=self.streaming)
+            else:
+                data = load_dataset(self.data_path, streaming=self.streaming)
 
-            from common.db import get_mysql_conn
-            conn = get_mysql_conn()
-            cur = conn.cursor()
+        return data
+
+    def load_db_train_data(self, s_iteration):
+        """
+        Stream the train rows of an iteration into an Arrow file through a server-side cursor, db_chunk_size rows
+        at a time, and open it memory-mapped. Memory is bounded by the chunk, not by the iteration.
+        """
+        from pymysql.cursors import SSCursor
+        from common.db import get_mysql_conn
+
+        os.makedirs(self.db_cache_dir, exist_ok=True)
+        path = os.path.join(self.db_cache_dir, "playbooks-{}.arrow".format(s_iteration))
+        tmp_path = "{}.tmp{}".format(path, os.getpid())
+        features = Features({"instruction": Value("string"), "input": Value("string"), "output": Value("string")})
+        # in-memory datasets get a random fingerprint, key the rows instead so the tokenized cache can hit
+        digest = hashlib.sha256()
+
+        conn = get_mysql_conn()
+        cur = conn.cursor(SSCursor)
+        writer = ArrowWriter(features=features, path=tmp_path)
+        try:
             sql = "select instruction,input,output from playbooks where iteration=%s and `type`='train'"
             cur.execute(sql, s_iteration)
-            items = cur.fetchall()
+            while True:
+                items = cur.fetchmany(self.db_chunk_size)
+                if not items:
+                    break
+                writer.write_batch({
+                    "instruction": [item[0] for item in items],
+                    "input": [item[1] for item in items],
+                    "output": [item[2] for item in items]
+                })
+                digest.update(json.dumps(items, default=str).encode("utf-8"))
+            writer.finalize()
+        finally:
+            writer.close()
             cur.close()
             conn.close()
-            for item in items:
-                instruction, input, output = item
-                train_data_set.append({
-                    "instruction": instruction,
-                    "input": input,
-                    "output": output
-                })
-            data = DatasetDict({"train": Dataset.from_list(train_data_set)})
-        elif self.data_path:
-            if self.data_path.endswith(".json") or self.data_path.endswith(".jsonl"):
-                data = load_dataset("json", data_files=self.data_path)
+        os.replace(tmp_path, path)
+
+        train_data = Dataset.from_file(path)
+        train_data._fingerprint = digest.hexdigest()
+
+        return train_data
+
+    def prompt_response(self, data_point):
+        """
+        The prompt of a plain instruction row and the prompt followed by its response, None for a multi-round
+        dialogue, whose labels tokenize_prompt masks turn by turn.
+        """
+        prompt = self.generate_prompt(data_point)
+        if 'multi-round dialogue' in prompt:
+            return None
+
+        return prompt, prompt + " " + data_point["output"] + " " + self.tokenizer.eos_token
+
+    def tokenize_response(self, prompt, prompt_with_response):
+        return self.tokenize_responses([prompt], [prompt_with_response])[0]
+
+    def tokenize_responses(self, prompts, prompts_with_response):
+        """
+        Tokenize every prompt + response in one call and ignore the labels of the tokens before the response starts.
+
+        The boundary is the first token whose offsets reach past the prompt, so the prompt is never tokenized on
+        its own and cannot split differently from how it does in front of the response. Needs a fast tokenizer.
+        """
+        result = self.tokenizer(
+            list(prompts_with_response),
+            truncation=True,
+            max_length=self.cutoff_len,
+            padding=False,
+            return_offsets_mapping=True,
+        )
+
+        tokenized = []
+        for prompt, input_ids, attention_mask, offsets in zip(
+                prompts, result["input_ids"], result["attention_mask"], result["offset_mapping"]
+        ):
+            source_len = next((i for i, (start, end) in enumerate(offsets) if end > len(prompt)), len(input_ids))
+            tokenized.append({
+                "input_ids": input_ids,
+                "attention_mask": attention_mask,
+                "labels": [IGNORE_INDEX] * source_len + input_ids[source_len:]
+            })
+
+        return tokenized
+
+    def tokenize_batch(self, batch):
+        """
+        Batched map function with exactly the rows tokenize_prompt gives one example at a time.
+
+        With a fast tokenizer the plain instruction rows of the batch go through a single tokenizer call, only
+        multi-round dialogues, and every row of a slow tokenizer, are tokenized one by one.
+        """
+        if self.task_type == "classify":
+            # no prompt template here, the labels are class indices
+            tokenize_res = self.tokenizer(batch["input"], truncation=True, padding=False)
+            tokenize_res["labels"] = [torch.tensor(self.labels.index(output)) for output in batch["output"]]
+
+            return tokenize_res
+
+        columns = list(batch.keys())
+        data_points = [dict(zip(columns, values)) for values in zip(*batch.values())]
+        tokenized = [None] * len(data_points)
+        if self.tokenizer.is_fast:
+            # generate_prompt may rewrite the row, tokenize_prompt has to get it untouched
+            pairs = {i: self.prompt_response(dict(data_point)) for i, data_point in enumerate(data_points)}
+            pairs = {i: pair for i, pair in pairs.items() if pair is not None}
+            if pairs:
+                prompts, prompts_with_response = zip(*pairs.values())
+                for i, tokenize_res in zip(pairs, self.tokenize_responses(prompts, prompts_with_response)):
+                    tokenized[i] = tokenize_res
+        for i, data_point in enumerate(data_points):
+            if tokenized[i] is None:
+                tokenized[i] = self.tokenize_prompt(data_point)
+
+        keys = []
+        for tokenize_res in tokenized:
+            keys += [key for key in tokenize_res if key not in keys]
+
+        return {key: [tokenize_res.get(key) for tokenize_res in tokenized] for key in keys}
+
+    def tokenize_data(self, data):
+        if isinstance(data, IterableDataset):
+            # tokenized on the fly while training reads it
+            return data.map(self.tokenize_batch, batched=True, batch_size=self.tokenize_batch_size)
+
+        return data.map(
+            self.tokenize_batch,
+            batched=True,
+            batch_size=self.tokenize_batch_size,
+            num_proc=self.num_proc if self.num_proc > 1 else None,
+        )
+
+    def tokenizer_hash(self):
+        """
+        Content hash of the tokenizer files in base_model, or its name when it is not a local dir.
+        """
+        digest = hashlib.sha256()
+        names = set(self.tokenizer.vocab_files_names.values()) | {
+            "tokenizer_config.json",
+            "special_tokens_map.json",
+            "added_tokens.json",
+            "tokenizer.json"
+        }
+        if os.path.isdir(self.base_model):
+            for name in sorted(names):
+                path = os.path.join(self.base_model, name)
+                if os.path.isfile(path):
+                    with open(path, "rb") as f:
+                        for chunk in iter(lambda: f.read(1 << 20), b""):
+                            digest.update(chunk)
+        else:
+            digest.update(self.base_model.encode("utf-8"))
+
+        return digest.hexdigest()
+
+    def tokenized_fingerprint(self, data):
+        """
+        Everything the tokenized splits depend on: the raw data, the tokenizer, the template and how it is applied.
+        """
+        methods = [
+            getattr(type(self), name)
+            for name in (
+                "generate_prompt", "tokenize", "tokenize_prompt", "prompt_response", "tokenize_response",
+                "tokenize_responses", "tokenize_pair", "tokenize_batch", "tokenize_data"
+            )
+            if hasattr(self, name)
+        ]
+        key = {
+            "data": data["train"]._fingerprint,
+            "tokenizer": self.tokenizer_hash(),
+            "tokenizer_class": type(self.tokenizer).__name__,
+            "tokenizer_name": self.tokenizer.name_or_path,
+            "vocab_size": len(self.tokenizer),
+            "cutoff_len": self.cutoff_len,
+            "add_eos_token": self.add_eos_token,
+            "prompt": PROMPT_DICT,
+            "model": "{}.{}".format(type(self).__module__, type(self).__qualname__),
+            # the helpers tokenize_prompt delegates to as well, editing any of them must not reuse the cache
+            "code": [inspect.getsource(method) for method in methods] + [inspect.getsource(mask_spans)],
+            "labels": self.labels if self.task_type == "classify" else None,
+            "val_set_size": self.val_set_size,
+        }
+
+        return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+    def split_train_data(self, data):
+        if isinstance(data["train"], IterableDataset):
+            return self.stream_splits(data)
+
+        train_data, val_data = self.cached_splits(data)
+        if self.packing:
+            train_data, val_data = self.pack_splits(train_data, val_data)
+
+        return train_data, val_data
+
+    def stream_splits(self, data):
+        """
+        Lazy splits of a streamed dataset: the first val_stream_size rows are held out, the rest is shuffled
+        through a buffer of shuffle_buffer_size rows and tokenized as it is read.
+        """
+        if self.packing or self.max_train_batch_tokens:
+            # both need the length of every example up front
+            print("Warning! Packing and token budget batches are not supported when streaming, train without them")
+            self.packing = False
+            self.max_train_batch_tokens = None
+
+        stream = data["train"]
+        val_data = None
+        if self.val_set_size > 0:
+            val_data = self.tokenize_data(stream.take(self.val_stream_size))
+            stream = stream.skip(self.val_stream_size)
+        train_data = self.tokenize_data(stream.shuffle(seed=42, buffer_size=self.shuffle_buffer_size))
+
+        return train_data, val_data
+
+    def cached_splits(self, data):
+        if not self.tokenized_cache or self.tokenized_cache == "None":
+            return self.tokenize_splits(data)
+
+        cache_dir = os.path.join(self.tokenized_cache, self.tokenized_fingerprint(data))
+        if os.path.isdir(cache_dir):
+            print("Using tokenized data from {}".format(cache_dir))
+            train_data = load_from_disk(os.path.join(cache_dir, "train"))
+            val_path = os.path.join(cache_dir, "val")
+            val_data = load_from_disk(val_path) if os.path.isdir(val_path) else None
+
+            return train_data, val_data
+
+        train_data, val_data = self.tokenize_splits(data)
+
+        # write aside and rename, a half written dir must never look like a cache hit
+        tmp_dir = "{}.tmp{}".format(cache_dir, os.getpid())
+        train_data.save_to_disk(os.path.join(tmp_dir, "train"))
+        if val_data is not None:
+            val_data.save_to_disk(os.path.join(tmp_dir, "val"))
+        try:
+            os.rename(tmp_dir, cache_dir)
+        except OSError:
+            # another rank got there first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        print("Saved tokenized data to {}".format(cache_dir))
+
+        return train_data, val_data
+
+    def tokenize_splits(self, data):
+        if self.val_set_size > 0:
+            train_val = data["train"].train_test_split(
+                test_size=self.val_set_size, shuffle=True, seed=42
+            )
+            train_data = self.tokenize_data(train_val["train"].shuffle())
+            val_data = self.tokenize_data(train_val["test"].shuffle())
+        else:
+            train_data = self.tokenize_data(data["train"].shuffle())
+            val_data = None
+
+        return train_data, val_data
+
+    def packed_attention(self):
+        """
+        Make the model family read the per-example segment ids packed windows keep in attention_mask.
+        """
+        raise NotImplementedError
+
+    def pack_splits(self, train_data, val_data):
+        if not self.support_packing or self.task_type != "seq2seq" or self.adapter not in ("lora", "qlora", "adalora"):
+            # prompt learning adapters prepend virtual tokens to the attention mask, which breaks the segments
+            print("Warning! Packing is not supported for {} with {}, train without packing".format(type(self).__name__, self.adapter))
+            self.packing = False
+            return train_data, val_data
+
+        self.packed_attention()
+        pad_token_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else 0
+
+        def pack(data):
+            return data.map(
+                pack_examples,
+                batched=True,
+                batch_size=self.tokenize_batch_size,
+                remove_columns=data.column_names,
+                fn_kwargs={"cutoff_len": self.cutoff_len, "pad_token_id": pad_token_id},
+            )
+
+        lengths = [len(input_ids) for input_ids in train_data["input_ids"]]
+        train_data = pack(train_data)
+        window_lengths = [sum(1 for segment in mask if segment) for mask in train_data["attention_mask"]]
+        print("Padding ratio: {:.1%} unpacked, {:.1%} packed ({} examples in {} windows of {} tokens)".format(
+            padding_ratio(lengths, self.per_gpu_train_batch_size),
+            padding_ratio(window_lengths, self.per_gpu_train_batch_size, self.cutoff_len),
+            len(lengths),
+            train_data.num_rows,
+            self.cutoff_len
+        ))
+        if val_data is not None:
+            val_data = pack(val_data)
+
+        return train_data, val_data
+
+    def load_base_model(self):
+        """
+        Load the model and tokenizer of the family with its default lora target modules, ready for an adapter.
+        """
+        raise NotImplementedError
+
+    def finetune(self, fromdb, iteration):
+        model = self.load_adapter_config(self.load_base_model())
+
+        data = self.load_train_data(fromdb, iteration)
+        print(data)
+        if not data:
+            print("Warning! Empty Train Data!")
+            return
+
+        train_data, val_data = self.split_train_data(data)
+
+        self.resume_adapter(model)
+
+        self.train(model, train_data, val_data)
+
+    def resume_adapter(self, model):
+        if not self.resume_from_checkpoint or self.resume_from_checkpoint is True:
+            return  # True lets the trainer pick the last checkpoint of output_dir
+
+        # Check the available weights and load them
+        checkpoint_name = os.path.join(
+            self.resume_from_checkpoint, "pytorch_model.bin"
+        )  # Full checkpoint
+        if not os.path.exists(checkpoint_name):
+            checkpoint_name = os.path.join(
+                self.resume_from_checkpoint, "adapter_model.safetensors"
+            )  # only adapter weights, as written by the async checkpoints
+            if not os.path.exists(checkpoint_name):
+                checkpoint_name = os.path.join(
+                    self.resume_from_checkpoint, "adapter_model.bin"
+                )  # only LoRA model - LoRA config above has to fit
+            if not os.path.exists(os.path.join(self.resume_from_checkpoint, "trainer_state.json")):
+                self.resume_from_checkpoint = (
+                    False  # So the trainer won't try loading its state
+                )
+            # else the trainer restores the optimizer, scheduler and step as well, as written by the async checkpoints
+        # The files above have a different name depending on how they were saved, but are actually the same.
+        if os.path.exists(checkpoint_name):
+            print(f"Restarting from {checkpoint_name}")
+            if checkpoint_name.endswith(".safetensors"):
+                adapters_weights = load_file(checkpoint_name)
             else:
-                data = load_dataset(self.data_path)
+                adapters_weights = torch.load(checkpoint_name)
+            set_peft_model_state_dict(model, adapters_weights)
+        else:
+            print(f"Checkpoint {checkpoint_name} not found")
 
-        return data
+    def get_data_collator(self, model):
+        return transformers.DataCollatorForSeq2Seq(self.tokenizer, return_tensors="pt", padding=True)
+
+    def enable_memory_saver(self, model):
+        """
+        Turn on gradient checkpointing, returns the loss chunk size when the chunked loss applies to this model.
+        """
+        if getattr(model, "supports_gradient_checkpointing", False):
+            model.gradient_checkpointing_enable()
+            # the frozen embeddings would otherwise leave the checkpointed layers without anything to backprop to
+            model.enable_input_require_grads()
+        else:
+            print("Warning! {} does not support gradient checkpointing".format(type(self).__name__))
+
+        # prompt learning adapters add virtual tokens to the outputs, classify has no lm head
+        if self.support_chunked_loss and self.task_type == "seq2seq" and self.adapter in ("lora", "qlora", "adalora"):
+            return self.loss_chunk_size
+        print("Warning! Chunked loss is not supported for {} with {}, use the model loss".format(type(self).__name__, self.adapter))
+
+        return None
+
+    def train(self, model, train_data, val_data):
+        world_size = self.world_size if self.ddp else 1
+        gradient_accumulation_steps = self.gradient_accumulation_steps
+        train_batch_sampler = None
+        if self.max_train_batch_tokens:
+            train_batch_sampler = TokenBudgetBatchSampler(
+                [len(input_ids) for input_ids in train_data["input_ids"]],
+                self.max_train_batch_tokens
+            )
+            # keep the samples per optimizer step of per_gpu_train_batch_size * gradient_accumulation_steps
+            samples_per_batch = train_data.num_rows / len(train_batch_sampler)
+            gradient_accumulation_steps = max(1, round(
+                self.per_gpu_train_batch_size * self.gradient_accumulation_steps / samples_per_batch
+            ))
+            print("Token budget {}: {} batches of {:.1f} samples on average, gradient_accumulation_steps {}".format(
+                self.max_train_batch_tokens, len(train_batch_sampler), samples_per_batch, gradient_accumulation_steps
+            ))
+            total_optim_steps = len(train_batch_sampler) // (gradient_accumulation_steps * world_size)
+        elif isinstance(train_data, IterableDataset):
+            total_optim_steps = self.max_steps
+        else:
+            total_batch_size = self.per_gpu_train_batch_size * gradient_accumulation_steps * world_size
+            total_optim_steps = train_data.num_rows // total_batch_size
+        dataloader_num_workers = self.dataloader_num_workers or 0
+        if isinstance(train_data, IterableDataset) and dataloader_num_workers > 0:
+            # datasets shards a stream across workers by data files, which the held out val rows (skip) cannot do
+            print("Warning! Data loader workers are not supported when streaming, load in the main process")
+            dataloader_num_workers = 0
+        saving_step = max(1, int(total_optim_steps / 10))
+        warmup_steps = int(total_optim_steps / 10)
+        # the async checkpoints replace the trainer's own synchronous full saves
+        async_checkpoint = bool(self.save_steps or self.save_minutes)
+        train_args = transformers.TrainingArguments(
+            per_device_train_batch_size=self.per_gpu_train_batch_size,
+            gradient_accumulation_steps=gradient_accumulation_steps,
+            warmup_steps=warmup_steps,
+            num_train_epochs=self.epochs,
+            learning_rate=self.learning_rate,
+            fp16=self.is_fp16,
+            bf16=self.is_bf16,
+            no_cuda=self.device == "cpu",
+            dataloader_num_workers=dataloader_num_workers,
+            optim="adamw_torch",
+            logging_steps=self.logging_steps,
+            evaluation_strategy="steps" if self.val_set_size > 0 else "no",
+            save_strategy="no" if async_checkpoint else "steps",
+            eval_steps=saving_step if self.val_set_size > 0 else None,
+            save_steps=saving_step,
+            max_steps=self.max_steps,
+            output_dir=self.output_dir,
+            save_total_limit=11,
+            load_best_model_at_end=True if self.val_set_size > 0 and not async_checkpoint else False,
+            ddp_find_unused_parameters=False if self.ddp else None,
+            group_by_length=self.group_by_length,
+            remove_unused_columns=not self.packing,  # keep position_ids of packed windows
+            use_mps_device=self.use_mps_device,
+            report_to=None if self.disable_wandb else "wandb"
+        )
+
+        loss_chunk_size = self.enable_memory_saver(model) if self.memory_saver else None
+
+        data_collator = self.get_data_collator(model)
+        trainer = LLMTrainer(
+            model=model,
+            train_dataset=train_data,
+            eval_dataset=val_data,
+            args=train_args,
+            data_collator=data_collator,
+            train_batch_sampler=train_batch_sampler,
+            inputs_hook=getattr(data_collator, "expand_inputs", None),
+            loss_chunk_size=loss_chunk_size,
+            throughput=ThroughputCallback(self.output_dir, self.tokenizer.pad_token_id, self.throughput_sync),
+            callbacks=[AsyncCheckpointCallback(self.output_dir, self.save_steps, self.save_minutes)] if async_checkpoint else None,
+        )
+
+        model.config.use_cache = False
+
+        if torch.__version__ >= "2" and sys.platform != "win32":
+            model = torch.compile(model)
+
+        trainer.train(resume_from_checkpoint=self.resume_from_checkpoint)
+
+        model.save_pretrained(self.output_dir)
+
+        print("\n If there's a warning about missing keys above, please disregard :)")
+
+        return trainer
+
+    def detach_adapter(self, base_model, base_modules):
+        """
+        Put back the modules of base_model an adapter replaced, base_modules being its named_modules() from before.
+        """
+        for name, module in base_modules.items():
+            if not name:
+                continue
+            parent_name, _, child_name = name.rpartition(".")
+            parent = base_modules[parent_name]
+            if getattr(parent, child_name) is not module:
+                setattr(parent, child_name, module)
+
+    def sweep(self, fromdb, iteration, configs):
+        r"""
+        Train one adapter per config on a base model and train data loaded and tokenized only once.
+
+        A config is a dict of sweep_options overriding the command line, e.g. {"lora_r": 16, "learning_rate": 1e-4}.
+        Its adapter is attached to the base model, trained and saved to output_dir/sweep-N, then detached by
+        putting back the base modules it replaced, the base weights are shared and never touched. This also works
+        on 8bit/4bit models, which peft cannot unload. Wall time, throughput and best eval loss of every run are
+        printed and written to output_dir/sweep.csv.
+        """
+        for config in configs:
+            for key in config:
+                if key not in self.sweep_options:
+                    raise KeyError("Unknow sweep option: {}".format(key))
+        if self.resume_from_checkpoint:
+            print("Warning! A sweep trains every adapter from scratch, resume_from_checkpoint is ignored")
+            self.resume_from_checkpoint = None
+
+        base_model = self.load_base_model()
+
+        data = self.load_train_data(fromdb, iteration)
+        print(data)
+        if not data:
+            print("Warning! Empty Train Data!")
+            return
+
+        train_data, val_data = self.split_train_data(data)
+
+        base_modules = dict(base_model.named_modules())
+        output_dir = self.output_dir
+        defaults = {key: getattr(self, key) for key in self.sweep_options}
+        results = []
+        for i, config in enumerate(configs):
+            for key, value in {**defaults, **config}.items():
+                setattr(self, key, value)
+            if (self.adapter == "qlora") != (defaults["adapter"] == "qlora"):
+                # qlora is lora on a 4bit base, the base model was loaded for --adapter
+                print("Warning! {} needs the base model loaded with --adapter {}, skip it".format(config, self.adapter))
+                continue
+            self.output_dir = os.path.join(output_dir, "sweep-{}".format(i))
+            os.makedirs(self.output_dir, exist_ok=True)
+            print("Sweep {}/{}: {}".format(i + 1, len(configs), config))
+
+            start = time.time()
+            trainer = self.train(self.load_adapter_config(base_model), train_data, val_data)
+            wall_time = time.time() - start
+
+            train_runtime = next(log["train_runtime"] for log in reversed(trainer.state.log_history) if "train_runtime" in log)
+            eval_losses = [log["eval_loss"] for log in trainer.state.log_history if "eval_loss" in log]
+            results.append({
+                "run": "sweep-{}".format(i),
+                "wall_time_sec": round(wall_time, 1),
+                "tokens_per_sec": round(trainer.throughput.total_tokens / train_runtime, 1),
+                "samples_per_sec": round(trainer.throughput.total_samples / train_runtime, 2),
+                "best_eval_loss": round(min(eval_losses), 4) if eval_losses else None,
+                "config": json.dumps(config),
+            })
+            is_main_process = trainer.is_world_process_zero()
+
+            # drop the trainer with its optimizer state before the next adapter is attached
+            del trainer
+            self.detach_adapter(base_model, base_modules)
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+        for key, value in defaults.items():
+            setattr(self, key, value)
+        self.output_dir = output_dir
+        if not results or not is_main_process:
+            return
+
+        columns = list(results[0].keys())
+        with open(os.path.join(output_dir, "sweep.csv"), "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(results)
+
+        print("{:<10}{:>14}{:>16}{:>17}{:>16}  {}".format(*columns))
+        for result in results:
+            print("{:<10}{:>14}{:>16}{:>17}{:>16}  {}".format(
+                result["run"], result["wall_time_sec"], result["tokens_per_sec"], result["samples_per_sec"],
+                "-" if result["best_eval_loss"] is None else result["best_eval_loss"], result["config"]
+            ))
 
     def get_eval_input(self, s_instruction, s_input, s_data, fromdb, s_type, s_iteration):
         result = []
@@ -219,6 +847,505 @@ class LLM:
 
         return result
 
+    def load_eval_model(self, compile=True):
+        self.auto_device()
+
+        fused = self.merge_adapter and self.adapter_weights != "None" and not self.adapters
+        if fused:
+            model = self.load_fused_model()
+        else:
+            model, self.tokenizer = self.get_model_tokenizer()
+
+        adapters = {}
+        if self.adapter_weights != "None" and not fused:
+            adapters["default"] = self.adapter_weights
+        adapters.update(self.adapters or {})
+        self.loaded_adapters = adapters
+
+        # the base weights are loaded once, every further adapter only adds its own weights
+        for name, weights in adapters.items():
+            if not isinstance(model, PeftModel):
+                model = PeftModel.from_pretrained(
+                    model,
+                    weights,
+                    adapter_name=name,
+                )
+                self.default_adapter = name
+            else:
+                model.load_adapter(weights, adapter_name=name)
+            print("Load adapter {} from {}".format(name, weights))
+
+        if not self.load_8bit:
+            model.to(self.eval_dtype())
+
+        model.to(self.device).eval()
+        if compile and torch.__version__ >= "2" and sys.platform != "win32":
+            model = torch.compile(model)
+
+        return model
+
+    def eval_dtype(self):
+        """
+        dtype of the eval weights: fp16 on gpus, on cpu bf16 where it is computed natively and fp32 otherwise.
+        """
+        if self.device == "cpu":
+            return torch.bfloat16 if self.is_bf16 else torch.float32
+
+        return torch.float16
+
+    def fused_weights(self):
+        """
+        Dir of the fused checkpoint of base_model + adapter_weights, keyed by the base, the adapter files and the dtype.
+        """
+        key = hashlib.sha256()
+        key.update(os.path.abspath(self.base_model).encode("utf-8"))
+        key.update(self.adapter_hash(self.adapter_weights).encode("utf-8"))
+        key.update(str(self.eval_dtype()).encode("utf-8"))
+
+        return os.path.join(self.fused_dir, key.hexdigest()[:16])
+
+    def adapter_hash(self, weights):
+        """
+        Content hash of the adapter_* files in the weights dir.
+        """
+        if self.adapter_hashes is None:
+            self.adapter_hashes = {}
+        if weights not in self.adapter_hashes:
+            digest = hashlib.sha256()
+            for name in sorted(os.listdir(weights)):
+                if name.startswith("adapter_"):
+                    with open(os.path.join(weights, name), "rb") as f:
+                        for chunk in iter(lambda: f.read(1 << 20), b""):
+                            digest.update(chunk)
+            self.adapter_hashes[weights] = digest.hexdigest()
+
+        return self.adapter_hashes[weights]
+
+    def export_fused_model(self, fused_dir):
+        with open(os.path.join(self.adapter_weights, "adapter_config.json"), "r") as f:
+            peft_type = json.load(f)["peft_type"]
+        if peft_type not in ("LORA", "ADALORA"):
+            raise ValueError("Only lora/qlora/adalora adapters can be merged, {} is not".format(peft_type))
+        if self.load_8bit:
+            raise ValueError("Adapters can not be merged into 8bit weights")
+
+        model, self.tokenizer = self.get_model_tokenizer()
+        model = PeftModel.from_pretrained(model, self.adapter_weights).merge_and_unload()
+        model.to(self.eval_dtype())
+
+        # write aside and rename, so an interrupted export is never picked up as a cached one
+        tmp_dir = fused_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        model.save_pretrained(tmp_dir, safe_serialization=True)
+        self.tokenizer.save_pretrained(tmp_dir)
+        for name in os.listdir(self.base_model):
+            if name.endswith(".py"):  # remote code of trust_remote_code models
+                shutil.copy(os.path.join(self.base_model, name), tmp_dir)
+        os.rename(tmp_dir, fused_dir)
+        print("Export fused model to {}".format(fused_dir))
+
+        return model
+
+    def load_fused_model(self):
+        """
+        Load base_model with adapter_weights merged in, so inference skips peft entirely.
+
+        The fused checkpoint is exported on first use and loaded directly from the cache afterwards.
+        """
+        fused_dir = self.fused_weights()
+        if not os.path.exists(os.path.join(fused_dir, "config.json")):
+            return self.export_fused_model(fused_dir)
+
+        base_model = self.base_model
+        self.base_model = fused_dir
+        try:
+            model, self.tokenizer = self.get_model_tokenizer()
+        finally:
+            self.base_model = base_model
+        print("Load fused model from {}".format(fused_dir))
+
+        return model
+
+    def find_adapters(self, specs):
+        """
+        Resolve --adapters specs into {name: weights dir}.
+
+        A spec is either name=path or a path named after its last dir. A dir without adapter_config.json, such as
+        output/, contributes every sub dir that has one.
+        """
+        adapters = {}
+        for spec in specs or []:
+            name, _, path = spec.rpartition("=")
+            path = path.rstrip("/")
+            if os.path.exists(os.path.join(path, "adapter_config.json")):
+                adapters[name or os.path.basename(path)] = path
+            elif os.path.isdir(path) and not name:
+                for sub in sorted(os.listdir(path)):
+                    if os.path.exists(os.path.join(path, sub, "adapter_config.json")):
+                        adapters[sub] = os.path.join(path, sub)
+            else:
+                raise KeyError("Unknow adapter: {}".format(spec))
+        if "default" in adapters:
+            # the slot of --adapter_weights, peft's own default adapter name too
+            raise KeyError("Adapter name default is reserved, pass {} as other_name=path".format(adapters["default"]))
+
+        return adapters
+
+    def use_adapter(self, model, name=None):
+        name = name or self.default_adapter
+        if name is None:
+            return
+        peft_config = getattr(model, "peft_config", None) or {}
+        if name not in peft_config:
+            raise KeyError("Unknow adapter: {}".format(name))
+        if model.active_adapter != name:
+            model.set_adapter(name)
+
+    def adapter_groups(self, model, eval_inputs):
+        """
+        Yield eval_inputs grouped by item["adapter"], with that adapter active on model.
+        """
+        groups = {}
+        for item in eval_inputs:
+            groups.setdefault(item.get("adapter") or self.default_adapter, []).append(item)
+        # before anything is generated, not halfway through the run
+        unknown = sorted(name for name in groups if name is not None and name not in (self.loaded_adapters or {}))
+        if unknown:
+            raise KeyError("Unknow adapter: {}, the loaded ones are: {}".format(
+                ", ".join(unknown), ", ".join(self.loaded_adapters or {}) or "none"
+            ))
+
+        for name, items in groups.items():
+            self.use_adapter(model, name)
+            yield items
+
+    def serve(self, host, port):
+        from core.server import serve
+
+        if self.prefix_cache:
+            # the scheduler prefills every prompt into its own running batch cache
+            print("Warning! The prefix cache is not used by the server, every prompt is prefilled in full")
+        # every decode step has a new shape, so torch.compile would only keep recompiling
+        model = self.load_eval_model(compile=False)
+        serve(self, model, host, port)
+
+    def generation_config(self, **kwargs):
+        if self.decoding_profile not in DECODING_PROFILES:
+            raise KeyError("Unknow decoding profile: {}".format(self.decoding_profile))
+        config = dict(
+            temperature=self.temperature,
+            top_p=self.top_p,
+            top_k=self.top_k,
+        )
+        config.update(DECODING_PROFILES[self.decoding_profile])
+        config.update(kwargs)
+
+        return GenerationConfig(**config)
+
+    def prefix_past(self, model, prompt, input_ids, num_beams=1):
+        """
+        Generate kwargs that let model.generate skip the prefill of the fixed template preamble.
+
+        The preamble's past_key_values are computed once per adapter and kept in self.prefix_kv, only the rest of
+        the prompt is prefilled on top of them. Returns {} whenever the cache cannot be used.
+        """
+        if not self.prefix_cache or not self.support_prefix_cache:
+            return {}
+        peft_config = getattr(model, "peft_config", None)
+        if peft_config and isinstance(peft_config[model.active_adapter], PromptLearningConfig):
+            return {}  # prompt learning adapters bring their own past_key_values
+
+        end = prompt.find("### Instruction:")
+        if end < 0:
+            return {}
+        preamble = prompt[:end].rstrip()
+
+        if self.prefix_kv is None:
+            self.prefix_kv = {}
+        key = (getattr(model, "active_adapter", None), preamble)
+        if key not in self.prefix_kv:
+            # drop the last token, it may merge with whatever follows the preamble
+            prefix_ids = self.tokenizer(preamble)["input_ids"][:-1]
+            with torch.no_grad():
+                outputs = model(input_ids=torch.tensor([prefix_ids], device=self.device), use_cache=True)
+            self.prefix_kv[key] = (prefix_ids, outputs.past_key_values)
+        prefix_ids, past_key_values = self.prefix_kv[key]
+
+        prefix_len = len(prefix_ids)
+        if input_ids.shape[1] <= prefix_len + 1 or input_ids[0, :prefix_len].tolist() != prefix_ids:
+            return {}
+
+        with torch.no_grad():
+            # prefill all but the last prompt token, model.generate feeds that one itself
+            past_key_values = model(
+                input_ids=input_ids[:, prefix_len:-1],
+                past_key_values=past_key_values,
+                attention_mask=torch.ones_like(input_ids[:, :-1]),
+                use_cache=True,
+            ).past_key_values
+        if num_beams > 1:
+            past_key_values = tuple(
+                tuple(t.repeat(num_beams, *[1] * (t.dim() - 1)) for t in layer) for layer in past_key_values
+            )
+
+        return {
+            "past_key_values": past_key_values,
+            "attention_mask": torch.ones_like(input_ids),
+        }
+
+    def stop_processor(self, prompt_len):
+        if not self.stop_markers or self.tokenizer.eos_token_id is None:
+            return None
+
+        return LogitsProcessorList([
+            StopMarkersLogitsProcessor(self.tokenizer, prompt_len, self.tokenizer.eos_token_id)
+        ])
+
+    def trim_response(self, response):
+        if self.stop_markers:
+            response = cut_stop_marker(response)[0]
+
+        return response.strip()
+
+    def evaluate(self,
+                 model,
+                 instruction,
+                 input=None,
+                 **kwargs,
+                 ):
+        prompt = self.generate_eval_prompt(instruction, input)
+        inputs = self.tokenizer(prompt, return_tensors="pt")
+        input_ids = inputs["input_ids"].to(self.device)
+        generation_config = self.generation_config(**kwargs)
+        with torch.no_grad():
+            generation_output = model.generate(
+                input_ids=input_ids,
+                generation_config=generation_config,
+                return_dict_in_generate=True,
+                output_scores=self.output_scores,
+                max_new_tokens=self.max_new_tokens,
+                logits_processor=self.stop_processor(input_ids.shape[1]),
+                **self.prefix_past(model, prompt, input_ids, generation_config.num_beams),
+            )
+        s = generation_output.sequences[0]
+        output = self.tokenizer.decode(s)
+
+        return self.trim_response(output.split("### Response:")[1])
+
+    def stream_evaluate(self, model, instruction, input=None, **kwargs):
+        """
+        Yield the response piece by piece while model.generate is still running.
+
+        The prompt is never echoed, so nothing has to be split off afterwards. Streaming needs a single beam.
+        """
+        prompt = self.generate_eval_prompt(instruction, input)
+        inputs = self.tokenizer(prompt, return_tensors="pt")
+        input_ids = inputs["input_ids"].to(self.device)
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        kwargs.setdefault("num_beams", 1)
+
+        errors = []
+
+        def run():
+            try:
+                with torch.no_grad():
+                    model.generate(
+                        input_ids=input_ids,
+                        generation_config=self.generation_config(**kwargs),
+                        max_new_tokens=self.max_new_tokens,
+                        streamer=streamer,
+                        logits_processor=self.stop_processor(input_ids.shape[1]),
+                        **self.prefix_past(model, prompt, input_ids),
+                    )
+            except Exception as e:
+                errors.append(e)
+                streamer.end()
+
+        thread = Thread(target=run, daemon=True)
+        thread.start()
+        text = ""
+        sent = 0
+        for piece in streamer:
+            text += piece
+            stopped = False
+            end = len(text)
+            if self.stop_markers:
+                # never show a stop marker, not even its first characters
+                text, stopped = cut_stop_marker(text)
+                end = len(text) if stopped else len(text) - pending_marker_len(text)
+            if end > sent:
+                yield text[sent:end]
+                sent = end
+            if stopped:
+                break
+        else:
+            if len(text) > sent:
+                yield text[sent:]
+        thread.join()
+        if errors:
+            raise errors[0]
+
+    def stream(self, instruction, input):
+        model = self.load_eval_model()
+
+        print("LLM says: ")
+        for text in self.stream_evaluate(model, instruction, input):
+            print(text, end="", flush=True)
+        print()
+
+    def batch_evaluate(self, model, eval_inputs, **kwargs):
+        """
+        Evaluate eval_inputs in micro-batches of self.batch_size, filling item["ac_output"] in place.
+
+        Prompts are sorted by tokenized length and left-padded, so every batch needs a single model.generate call
+        and wastes little on padding. Results are written back to the original items, so the order is unchanged.
+        """
+        prompts = [self.generate_eval_prompt(item["instruction"], item["input"]) for item in eval_inputs]
+        lengths = [len(input_ids) for input_ids in self.tokenizer(prompts)["input_ids"]]
+
+        padding_side = self.tokenizer.padding_side
+        pad_token = self.tokenizer.pad_token
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token_id is None and self.tokenizer.eos_token is not None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        pad_token_id = self.tokenizer.pad_token_id
+
+        try:
+            for batch in length_sorted_batches(lengths, batch_size=self.batch_size):
+                try:
+                    inputs = self.tokenizer([prompts[i] for i in batch], return_tensors="pt", padding=True)
+                    with torch.no_grad():
+                        generation_output = model.generate(
+                            input_ids=inputs["input_ids"].to(self.device),
+                            attention_mask=inputs["attention_mask"].to(self.device),
+                            generation_config=self.generation_config(pad_token_id=pad_token_id, **kwargs),
+                            return_dict_in_generate=True,
+                            output_scores=self.output_scores,
+                            max_new_tokens=self.max_new_tokens,
+                            logits_processor=self.stop_processor(inputs["input_ids"].shape[1]),
+                        )
+                    # decode every row as if generated alone: without its left padding, up to its first eos
+                    prompt_width = inputs["input_ids"].shape[1]
+                    prompt_lens = inputs["attention_mask"].sum(dim=1).tolist()
+                    responses = []
+                    for s, prompt_len in zip(generation_output.sequences.tolist(), prompt_lens):
+                        generated = s[prompt_width:]
+                        if self.tokenizer.eos_token_id in generated:
+                            generated = generated[:generated.index(self.tokenizer.eos_token_id) + 1]
+                        output = self.tokenizer.decode(s[prompt_width - prompt_len:prompt_width] + generated)
+                        response = self.trim_response(output.split("### Response:")[1])
+                        if response[-4:] == "</s>":
+                            response = response[:-4]
+                        responses.append(response)
+                except Exception as e:
+                    print("Eval Error in a batch of {}: {}".format(len(batch), repr(e)))
+                    responses = ["Eval Error"] * len(batch)
+
+                for i, response in zip(batch, responses):
+                    eval_inputs[i]["ac_output"] = response
+        finally:
+            self.tokenizer.padding_side = padding_side
+            self.tokenizer.pad_token = pad_token
+
+    def batch_classify(self, model, eval_inputs):
+        """
+        Classify eval_inputs in token-budgeted batches, one forward pass per batch.
+
+        Every item gets the argmax label in item["ac_output"] and the softmax over self.labels in item["probs"].
+        """
+        texts = [item["input"] for item in eval_inputs]
+        lengths = [len(input_ids) for input_ids in self.tokenizer(texts)["input_ids"]]
+
+        # sequence classification heads pick the last non-pad token, which needs right padding and a pad id
+        padding_side = self.tokenizer.padding_side
+        self.tokenizer.padding_side = "right"
+        model.config.pad_token_id = self.tokenizer.pad_token_id
+
+        try:
+            for batch in length_sorted_batches(lengths, batch_size=self.batch_size, max_tokens=self.max_batch_tokens):
+                try:
+                    inputs = self.tokenizer([texts[i] for i in batch], return_tensors="pt", padding=True).to(self.device)
+                    with torch.no_grad():
+                        probs = torch.softmax(model(**inputs).logits.float(), dim=-1)
+                    predicted = probs.argmax(dim=-1).tolist()
+                    probs = probs.tolist()
+                    for j, i in enumerate(batch):
+                        eval_inputs[i]["ac_output"] = self.labels[predicted[j]]
+                        eval_inputs[i]["probs"] = probs[j]
+                except:
+                    for i in batch:
+                        eval_inputs[i]["ac_output"] = "Eval Error"
+        finally:
+            self.tokenizer.padding_side = padding_side
+
+    def response_key(self, model, prompt):
+        """
+        Content hash of everything that decides the response: base model, active adapter, prompt, generate params
+        and the stop markers cutting it short.
+        """
+        adapter = self.adapter_weights if self.merge_adapter else None
+        if getattr(model, "peft_config", None):
+            adapter = self.loaded_adapters[model.active_adapter]
+        key = {
+            "base_model": os.path.abspath(self.base_model),
+            "adapter": self.adapter_hash(adapter) if adapter and adapter != "None" else None,
+            "prompt": prompt,
+            "generation_config": self.generation_config().to_dict(),
+            "max_new_tokens": self.max_new_tokens,
+            "stop_markers": STOP_MARKERS if self.stop_markers else None,
+        }
+
+        return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def eval_items(self, model, eval_inputs):
+        """
+        Fill item["ac_output"] for every eval input, per adapter, one by one or batched.
+
+        With a response cache, inputs answered by an earlier run are served from it and never reach evaluate().
+        """
+        if self.response_cache and self.response_cache_db is None:
+            from common.cache import ResponseCache
+            self.response_cache_db = ResponseCache(self.response_cache, self.response_cache_size)
+        cache = self.response_cache_db
+        if self.prefix_cache and self.batch_size > 1:
+            # the preamble would have to sit before the left padding of every row
+            print("Warning! The prefix cache is not used with batch_size > 1, every prompt is prefilled in full")
+
+        for items in self.adapter_groups(model, eval_inputs):
+            keys = {}
+            if cache:
+                pending = []
+                for item in items:
+                    key = self.response_key(model, self.generate_eval_prompt(item["instruction"], item["input"]))
+                    response = cache.get(key)
+                    if response is None:
+                        keys[id(item)] = key
+                        pending.append(item)
+                    else:
+                        item["ac_output"] = response
+                items = pending
+
+            if self.batch_size > 1:
+                self.batch_evaluate(model, items)
+            else:
+                for item in items:
+                    try:
+                        response = self.evaluate(model, item["instruction"], item["input"])
+                        if response[-4:] == "</s>":
+                            response = response[:-4]
+                    except:
+                        response = "Eval Error"
+
+                    item["ac_output"] = response
+
+            if cache:
+                for item in items:
+                    if item["ac_output"] != "Eval Error":
+                        cache.put(keys[id(item)], item["ac_output"])
+
+        if cache:
+            print(cache.stats())
+
     def eval_output(self, eval_inputs, s_data, fromdb, s_type, s_iteration, s_test_iteration):
         if fromdb:
             data_set = []
@@ -241,5 +1368,7 @@ class LLM:
             for item in eval_inputs:
                 case_cnt += 1
                 print("[*] Case: {}\n--------\nExpect: \n{}\n----------------\nOutput: \n{}\n".format(case_cnt, item["output"], item["ac_output"]))
+                if "probs" in item:
+                    print("Probs: {}\n".format(dict(zip(self.labels, item["probs"]))))
         else:
             print("LLM says: \n{}".format(eval_inputs[0]["ac_output"]))
@@ -1,18 +1,15 @@
-import os
-import sys
 import re
 import copy
 import torch
-import transformers
 from typing import Dict, Optional, Sequence, Union
 
 from common.base import IGNORE_INDEX
 from common.prompt import PROMPT_DICT
+from common.masking import mask_spans
 
 from transformers import (
     AutoModel,
     AutoTokenizer,
-    GenerationConfig,
     DataCollatorWithPadding,
     BatchEncoding,
     BitsAndBytesConfig
@@ -21,9 +18,7 @@ from transformers.modeling_utils import PreTrainedModel
 from transformers.tokenization_utils import PreTrainedTokenizer
 
 from peft import (
-    prepare_model_for_int8_training,
-    set_peft_model_state_dict,
-    PeftModel
+    prepare_model_for_int8_training
 )
 
 from core.llm import LLM
@@ -39,10 +34,13 @@ class ChatGLMCollator(DataCollatorWithPadding):
             tokenizer: PreTrainedTokenizer,
             model: PreTrainedModel,
             ignore_pad_token_for_loss: Optional[bool] = False,
-            use_v2: Optional[bool] = False
+            use_v2: Optional[bool] = False,
+            compact_masks: Optional[bool] = False
     ):
         super().__init__(tokenizer, padding=True)
         self.model = model
+        # v1 masks are (batch, 1, seq, seq), with compact_masks batches carry (pad_len, ctx_len) rows instead
+        self.compact_masks = compact_masks and not use_v2
         self.label_pad_token_id = IGNORE_INDEX if ignore_pad_token_for_loss else tokenizer.pad_token_id
         if use_v2:
             self.get_attention_masks = self.get_attention_masks_v2
@@ -51,6 +49,17 @@ class ChatGLMCollator(DataCollatorWithPadding):
             self.get_attention_masks = self.get_attention_masks_v1
             self.get_position_ids = self.get_position_ids_v1
 
+    def get_padding_context_lengths(self, input_ids: torch.Tensor):
+        r"""
+        Padding length (first non-pad token) and context length (first bos token) of every left-padded row.
+
+        argmax returns the first maximal index, so this needs no per-row host sync.
+        """
+        padding_lengths = (input_ids != self.tokenizer.pad_token_id).int().argmax(dim=-1)
+        context_lengths = (input_ids == self.tokenizer.bos_token_id).int().argmax(dim=-1)
+
+        return padding_lengths, context_lengths
+
     def get_attention_masks_v1(self, input_ids: torch.Tensor, device: torch.device) -> torch.Tensor:
         r"""
         Generates attention masks for left-padded sequences.
@@ -59,17 +68,28 @@ class ChatGLMCollator(DataCollatorWithPadding):
 
         According to: https://huggingface.co/THUDM/chatglm-6b/blob/v1.1.0/modeling_chatglm.py#L680
         """
-        batch_size, seq_length = input_ids.size()
-        attention_mask = torch.ones((batch_size, seq_length, seq_length), device=device)
-        attention_mask.tril_()
+        padding_lengths, context_lengths = self.get_padding_context_lengths(input_ids)
 
-        for i, seq in enumerate(input_ids):
-            attention_mask[i, :, :(seq == self.tokenizer.bos_token_id).nonzero()[0].item()] = 1  # context
-            attention_mask[i, :, :(seq != self.tokenizer.pad_token_id).nonzero()[0].item()] = 0  # padding
+        return self.build_attention_masks_v1(padding_lengths, context_lengths, input_ids.size(1), device)
 
-        attention_mask.unsqueeze_(1)
-        attention_mask = (attention_mask < 0.5).bool()
-        return attention_mask
+    def build_attention_masks_v1(
+            self,
+            padding_lengths: torch.Tensor,
+            context_lengths: torch.Tensor,
+            seq_length: int,
+            device: torch.device
+    ) -> torch.Tensor:
+        r"""
+        Builds the bool v1 attention masks straight from the padding and context length of every row.
+        """
+        positions = torch.arange(seq_length, device=device)
+
+        # causal, plus the whole context for every query, minus the padding
+        attended = positions[None, None, :] <= positions[None, :, None]
+        attended = attended | (positions[None, :] < context_lengths[:, None].to(device))[:, None, :]
+        attended = attended & (positions[None, :] >= padding_lengths[:, None].to(device))[:, None, :]
+
+        return (~attended).unsqueeze(1)
 
     def get_position_ids_v1(self, input_ids: torch.Tensor, device: torch.device) -> torch.Tensor:
         r"""
@@ -80,28 +100,20 @@ class ChatGLMCollator(DataCollatorWithPadding):
         batch_size, seq_length = input_ids.size()
         mask: int = self.model.config.mask_token_id
         gmask: int = self.model.config.gmask_token_id
-        position_ids = torch.zeros((batch_size, seq_length), dtype=torch.long, device=device)
-        block_position_ids = torch.zeros((batch_size, seq_length), dtype=torch.long, device=device)
-
-        for i, seq in enumerate(input_ids):
-            mask_token = gmask if gmask in seq else mask
-            context_length = (seq == self.tokenizer.bos_token_id).nonzero()[0].item()
-            padding_length = (seq != self.tokenizer.pad_token_id).nonzero()[0].item()
-            position_ids[i, padding_length:] = torch.arange(
-                seq_length - padding_length,
-                dtype=torch.long,
-                device=device
-            )
-            if self.model.position_encoding_2d or (mask_token != gmask):  # 2d position encoding or not gMASK
-                position_ids[i, context_length:] = (seq == mask_token).nonzero()[
-                                                       0].item() - padding_length  # mask position
-            block_position_ids[i, context_length:] = torch.arange(
-                seq_length - context_length,
-                dtype=torch.long,
-                device=device
-            ) + 1
+        padding_lengths, context_lengths = self.get_padding_context_lengths(input_ids.to(device))
+        positions = torch.arange(seq_length, dtype=torch.long, device=device)[None, :]
+
+        use_gmask = (input_ids == gmask).any(dim=-1).to(device)
+        mask_tokens = torch.where(use_gmask, gmask, mask)
+        mask_positions = (input_ids.to(device) == mask_tokens[:, None]).int().argmax(dim=-1)
+
+        position_ids = (positions - padding_lengths[:, None]).clamp(min=0)
+        # 2d position encoding or not gMASK, the generated part sits at the mask position
+        at_mask = (positions >= context_lengths[:, None]) & (self.model.position_encoding_2d | ~use_gmask)[:, None]
+        position_ids = torch.where(at_mask, (mask_positions - padding_lengths)[:, None], position_ids)
 
         if self.model.position_encoding_2d:
+            block_position_ids = (positions - context_lengths[:, None] + 1).clamp(min=0)
             position_ids = torch.stack((position_ids, block_position_ids), dim=1)
 
         return position_ids
@@ -111,26 +123,20 @@ class ChatGLMCollator(DataCollatorWithPadding):
         Generates attention masks for left-padded sequences.
         """
         batch_size, seq_length = input_ids.size()
-        attention_mask = torch.ones((batch_size, seq_length), device=device)
-
-        for i, seq in enumerate(input_ids):
-            attention_mask[i, :(seq != self.tokenizer.pad_token_id).nonzero()[0].item()] = 0  # padding
+        padding_lengths, _ = self.get_padding_context_lengths(input_ids)
+        positions = torch.arange(seq_length, device=device)
 
-        return attention_mask
+        return (positions[None, :] >= padding_lengths[:, None].to(device)).float()
 
     def get_position_ids_v2(self, input_ids: torch.Tensor, device: torch.device) -> torch.Tensor:
         r"""
         Generates position ids for left-padded sequenes.
         """
         batch_size, seq_length = input_ids.size()
-        position_ids = torch.zeros((batch_size, seq_length), dtype=torch.long, device=device)
+        padding_lengths, _ = self.get_padding_context_lengths(input_ids)
+        positions = torch.arange(seq_length, dtype=torch.long, device=device)
 
-        for i, seq in enumerate(input_ids):
-            padding_length = (seq != self.tokenizer.pad_token_id).nonzero()[0].item()
-            position_ids[i, padding_length:] = torch.arange(seq_length - padding_length, dtype=torch.long,
-                                                            device=device)
-
-        return position_ids
+        return (positions[None, :] - padding_lengths[:, None].to(device)).clamp(min=0)
 
     def __call__(self, features: Sequence[Dict[str, Union[torch.Tensor, Sequence[int]]]]) -> BatchEncoding:
         r"""
@@ -164,14 +170,35 @@ class ChatGLMCollator(DataCollatorWithPadding):
             batch["labels"] = labels
 
         batch["input_ids"] = input_ids
-        batch["attention_mask"] = self.get_attention_masks(input_ids, device=input_ids.device)
+        if self.compact_masks:
+            batch["mask_lengths"] = torch.stack(self.get_padding_context_lengths(input_ids), dim=-1)
+        else:
+            batch["attention_mask"] = self.get_attention_masks(input_ids, device=input_ids.device)
         batch["position_ids"] = self.get_position_ids(input_ids, device=input_ids.device)
 
         return BatchEncoding(batch)
 
+    def expand_inputs(self, inputs: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        r"""
+        Materializes the attention masks of a compact batch, once and on the device the batch was moved to.
+        """
+        if "mask_lengths" in inputs:
+            mask_lengths = inputs.pop("mask_lengths")
+            inputs["attention_mask"] = self.build_attention_masks_v1(
+                mask_lengths[:, 0],
+                mask_lengths[:, 1],
+                inputs["input_ids"].size(1),
+                inputs["input_ids"].device
+            )
+
+        return inputs
+
 
 class ChatGLMSeq2Seq(LLM):
     tokenizer = None
+    support_prefix_cache = False  # ChatGLM keeps past_key_values sequence-first
+    kv_cache_dims = None  # ChatGLM finds <sop>/[gMASK] in the whole input and ignores the padding mask
+    support_chunked_loss = False  # ChatGLM2 keeps its output layer inside the transformer
 
     def get_model_tokenizer(self):
         bnb_config = None
@@ -184,7 +211,7 @@ class ChatGLMSeq2Seq(LLM):
         model = AutoModel.from_pretrained(
             self.base_model,
             load_in_8bit=self.load_8bit,
-            torch_dtype=torch.float16,
+            torch_dtype=torch.float32 if self.device == "cpu" else torch.float16,  # no fp16 matmuls on cpu
             trust_remote_code=True,
             device_map=self.device_map,
             quantization_config=bnb_config
@@ -209,29 +236,26 @@ class ChatGLMSeq2Seq(LLM):
 
         return prompt_.format_map(data_point)
 
-    def prompt_tokenize(self, prompt):
-        input_ids = self.tokenizer.encode(
-            prompt,
-            truncation=True,
-            max_length=self.cutoff_len,
-            #    padding="max_length",
-            padding=False,
-        )
-        return {
-            "input_ids": input_ids,
-            "labels": copy.deepcopy(input_ids)
-        }
+    def tokenize_pair(self, prompt, response):
+        """
+        Tokenize the prompt and the response once each, without special tokens, and join them the way ChatGLM
+        does: [gMASK] <sop> after (v1) or before (v2) the prompt and eos after the response.
+
+        This is two encode calls on purpose, not one pass over prompt + response with the boundary taken from
+        offsets as in tokenize_responses: the ChatGLM tokenizers are slow sentencepiece tokenizers without offset
+        mappings. It also matches inference, where the prompt is encoded alone and the response is generated after
+        it, so no token ever spans the boundary there either.
+        """
+        prompt_ids = self.tokenizer.encode(text=prompt, add_special_tokens=False)[:self.cutoff_len - 3]
+        response_ids = self.tokenizer.encode(text=response, add_special_tokens=False)
+        response_ids = response_ids[:self.cutoff_len - 3 - len(prompt_ids)]
+
+        source_len = len(self.tokenizer.build_inputs_with_special_tokens(prompt_ids))
+        input_ids = self.tokenizer.build_inputs_with_special_tokens(prompt_ids, response_ids)
 
-    def completion_tokenize(self, completion):
-        input_ids = self.tokenizer.encode(
-            completion,
-            truncation=True,
-            max_length=self.cutoff_len,
-            # add_special_tokens=False
-        )
         return {
             "input_ids": input_ids,
-            "labels": copy.deepcopy(input_ids)
+            "labels": [IGNORE_INDEX] * source_len + input_ids[source_len:]
         }
 
     def tokenize_prompt(self, data_point):
@@ -247,20 +271,7 @@ class ChatGLMSeq2Seq(LLM):
 
             matches = re.finditer(r'### (?!Assistant:)(.*?)</s>', prompt_no_resp, re.DOTALL)
 
-            for match in matches:
-                start_pos, end_pos = match.span()
-                start_idx = None
-                end_idx = None
-
-                for i, (start, end) in enumerate(offsets):
-                    if start <= start_pos < end:
-                        start_idx = i
-                    if start <= end_pos < end:
-                        end_idx = i
-
-                if start_idx is not None and end_idx is not None:
-                    for i in range(start_idx, end_idx - 1):
-                        labels[i] = IGNORE_INDEX
+            mask_spans(labels, offsets, [match.span() for match in matches])
 
             return dict(
                 input_ids=inputs_with_offsets['input_ids'],
@@ -268,41 +279,18 @@ class ChatGLMSeq2Seq(LLM):
                 labels=labels,
             )
         else:
-            tokenized_result = self.prompt_tokenize(prompt_no_resp)
+            return self.tokenize_pair(prompt_no_resp, data_point["output"])
 
-            source_len = len(tokenized_result['input_ids'])
-            prompt_with_response = prompt_no_resp + " " + data_point["output"]
-            prompt_with_response += " " + self.tokenizer.eos_token
-
-            tokenized_with_response = self.completion_tokenize(prompt_with_response)
-            tokenized_with_response["input_ids"] = tokenized_result['input_ids'] + tokenized_with_response["input_ids"][
-                                                                                   source_len - 2:-2]
-            tokenized_with_response["labels"] = tokenized_result['labels'] + tokenized_with_response["labels"][
-                                                                             source_len - 2:-2]
-
-            tokenized_with_response["labels"] = [IGNORE_INDEX] * source_len + tokenized_with_response["labels"][
-                                                                              source_len:]
-
-            return tokenized_with_response
-
-    def split_train_data(self, data):
-        if self.val_set_size > 0:
-            train_val = data["train"].train_test_split(
-                test_size=self.val_set_size, shuffle=True, seed=42
-            )
-            train_data = (
-                train_val["train"].shuffle().map(self.tokenize_prompt)
-            )
-            val_data = (
-                train_val["test"].shuffle().map(self.tokenize_prompt)
-            )
-        else:
-            train_data = data["train"].shuffle().map(self.tokenize_prompt)
-            val_data = None
-
-        return train_data, val_data
+    def get_data_collator(self, model):
+        return ChatGLMCollator(
+            self.tokenizer,
+            model=model,
+            ignore_pad_token_for_loss=False,
+            use_v2=True if self.model_type == "chatglm2" else False,
+            compact_masks=True
+        )
 
-    def finetune(self, fromdb, iteration):
+    def load_base_model(self):
         self.auto_device()
 
         if not self.lora_target_modules:
@@ -314,88 +302,7 @@ class ChatGLMSeq2Seq(LLM):
         if self.load_8bit:
             model = prepare_model_for_int8_training(model)
 
-        model = self.load_adapter_config(model)
-
-        data = self.load_train_data(fromdb, iteration)
-        print(data)
-        if not data:
-            print("Warning! Empty Train Data!")
-            return
-
-        train_data, val_data = self.split_train_data(data)
-
-        if self.resume_from_checkpoint:
-            # Check the available weights and load them
-            checkpoint_name = os.path.join(
-                self.resume_from_checkpoint, "pytorch_model.bin"
-            )  # Full checkpoint
-            if not os.path.exists(checkpoint_name):
-                checkpoint_name = os.path.join(
-                    self.resume_from_checkpoint, "adapter_model.bin"
-                )  # only LoRA model - LoRA config above has to fit
-                self.resume_from_checkpoint = (
-                    False  # So the trainer won't try loading its state
-                )
-            # The two files above have a different name depending on how they were saved, but are actually the same.
-            if os.path.exists(checkpoint_name):
-                print(f"Restarting from {checkpoint_name}")
-                adapters_weights = torch.load(checkpoint_name)
-                set_peft_model_state_dict(model, adapters_weights)
-            else:
-                print(f"Checkpoint {checkpoint_name} not found")
-
-        total_batch_size = self.per_gpu_train_batch_size * self.gradient_accumulation_steps * (
-            self.world_size if self.ddp else 1)
-        total_optim_steps = train_data.num_rows // total_batch_size
-        saving_step = int(total_optim_steps / 10)
-        warmup_steps = int(total_optim_steps / 10)
-
-        train_args = transformers.TrainingArguments(
-            per_device_train_batch_size=self.per_gpu_train_batch_size,
-            gradient_accumulation_steps=self.gradient_accumulation_steps,
-            warmup_steps=warmup_steps,
-            num_train_epochs=self.epochs,
-            learning_rate=self.learning_rate,
-            fp16=self.is_fp16,
-            optim="adamw_torch",
-            logging_steps=self.logging_steps,
-            evaluation_strategy="steps" if self.val_set_size > 0 else "no",
-            save_strategy="steps",
-            eval_steps=saving_step if self.val_set_size > 0 else None,
-            save_steps=saving_step,
-            # max_steps=200,
-            output_dir=self.output_dir,
-            save_total_limit=11,
-            load_best_model_at_end=True if self.val_set_size > 0 else False,
-            ddp_find_unused_parameters=False if self.ddp else None,
-            group_by_length=self.group_by_length,
-            use_mps_device=self.use_mps_device,
-            report_to=None if self.disable_wandb else "wandb"
-        )
-
-        trainer = transformers.Trainer(
-            model=model,
-            train_dataset=train_data,
-            eval_dataset=val_data,
-            args=train_args,
-            data_collator=ChatGLMCollator(
-                self.tokenizer,
-                model=model,
-                ignore_pad_token_for_loss=False,
-                use_v2=True if self.model_type == "chatglm2" else False
-            ),
-        )
-
-        model.config.use_cache = False
-
-        if torch.__version__ >= "2" and sys.platform != "win32":
-            model = torch.compile(model)
-
-        trainer.train(resume_from_checkpoint=self.resume_from_checkpoint)
-
-        model.save_pretrained(self.output_dir)
-
-        print("\n If there's a warning about missing keys above, please disregard :)")
+        return model
 
     def generate_eval_prompt(self, instruction, input=None):
         if input:
@@ -416,67 +323,12 @@ class ChatGLMSeq2Seq(LLM):
 
     ### Response:"""
 
-    def evaluate(self,
-                 model,
-                 instruction,
-                 input=None,
-                 **kwargs,
-                 ):
-        prompt = self.generate_eval_prompt(instruction, input)
-        inputs = self.tokenizer(prompt, return_tensors="pt")
-        input_ids = inputs["input_ids"].to(self.device)
-        generation_config = GenerationConfig(
-            temperature=self.temperature,
-            top_p=self.top_p,
-            top_k=self.top_k,
-            num_beams=4,
-            do_sample=True,
-            no_repeat_ngram_size=6,
-            repetition_penalty=1.8,
-            **kwargs,
-        )
-        with torch.no_grad():
-            generation_output = model.generate(
-                input_ids=input_ids,
-                generation_config=generation_config,
-                return_dict_in_generate=True,
-                output_scores=True,
-                max_new_tokens=self.max_new_tokens,
-            )
-        s = generation_output.sequences[0]
-        output = self.tokenizer.decode(s)
-
-        return output.split("### Response:")[1].strip()
-
     def generate(self, instruction, input, data, fromdb, type, iteration, test_iteration):
-        self.auto_device()
-
-        model, self.tokenizer = self.get_model_tokenizer()
-
-        if self.adapter_weights != "None":
-            model = PeftModel.from_pretrained(
-                model,
-                self.adapter_weights,
-            )
-
-        if not self.load_8bit:
-            model.half()
-
-        model.to(self.device).eval()
-        if torch.__version__ >= "2" and sys.platform != "win32":
-            model = torch.compile(model)
+        model = self.load_eval_model()
 
         eval_inputs = self.get_eval_input(instruction, input, data, fromdb, type, iteration)
 
-        for item in eval_inputs:
-            try:
-                response = self.evaluate(model, item["instruction"], item["input"])
-                if response[-4:] == "</s>":
-                    response = response[:-4]
-            except:
-                response = "Eval Error"
-
-            item["ac_output"] = response
+        self.eval_items(model, eval_inputs)
 
         self.eval_output(eval_inputs, data, fromdb, type, iteration, test_iteration)
 
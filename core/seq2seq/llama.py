@@ -1,24 +1,23 @@
 import os
-import sys
 import re
 import copy
 import torch
-import transformers
 
 from common.base import IGNORE_INDEX
 from common.prompt import PROMPT_DICT
+from common.masking import mask_spans
+from common.packing import segment_attention_mask
 
 from transformers import (
     LlamaForCausalLM,
+    LlamaModel,
     LlamaTokenizer,
-    GenerationConfig,
+    LlamaTokenizerFast,
     BitsAndBytesConfig
 )
 
 from peft import (
-    prepare_model_for_int8_training,
-    set_peft_model_state_dict,
-    PeftModel
+    prepare_model_for_int8_training
 )
 
 from core.llm import LLM
@@ -26,6 +25,7 @@ from core.llm import LLM
 
 class LLAMASeq2Seq(LLM):
     tokenizer = None
+    support_packing = True
 
     def get_model_tokenizer(self):
         bnb_config = None
@@ -44,7 +44,12 @@ class LLAMASeq2Seq(LLM):
             quantization_config=bnb_config,
             trust_remote_code=True,
         )
-        tokenizer = LlamaTokenizer.from_pretrained(
+        # a shipped tokenizer.json only, converting the sentencepiece model may split some text differently
+        if os.path.isfile(os.path.join(self.base_model, "tokenizer.json")):
+            tokenizer_class = LlamaTokenizerFast
+        else:
+            tokenizer_class = LlamaTokenizer
+        tokenizer = tokenizer_class.from_pretrained(
             self.base_model,
             trust_remote_code=True,
             add_eos_token=self.add_eos_token
@@ -103,20 +108,7 @@ class LLAMASeq2Seq(LLM):
 
             matches = re.finditer(r'### (?!Assistant:)(.*?)</s>', prompt_no_resp, re.DOTALL)
 
-            for match in matches:
-                start_pos, end_pos = match.span()
-                start_idx = None
-                end_idx = None
-
-                for i, (start, end) in enumerate(offsets):
-                    if start <= start_pos < end:
-                        start_idx = i
-                    if start <= end_pos < end:
-                        end_idx = i
-
-                if start_idx is not None and end_idx is not None:
-                    for i in range(start_idx, end_idx - 1):
-                        labels[i] = IGNORE_INDEX
+            mask_spans(labels, offsets, [match.span() for match in matches])
 
             return dict(
                 input_ids=inputs_with_offsets['input_ids'],
@@ -124,11 +116,15 @@ class LLAMASeq2Seq(LLM):
                 labels=labels,
             )
         else:
+            prompt_with_response = prompt_no_resp + " " + data_point["output"]
+            prompt_with_response += " " + self.tokenizer.eos_token
+
+            if self.tokenizer.is_fast:
+                return self.tokenize_response(prompt_no_resp, prompt_with_response)
+
             tokenized_result = self.tokenize(prompt_no_resp)
 
             source_len = len(tokenized_result['input_ids'])
-            prompt_with_response = prompt_no_resp + " " + data_point["output"]
-            prompt_with_response += " " + self.tokenizer.eos_token
 
             tokenized_with_response = self.tokenize(prompt_with_response)
 
@@ -136,24 +132,22 @@ class LLAMASeq2Seq(LLM):
 
             return tokenized_with_response
 
-    def split_train_data(self, data):
-        if self.val_set_size > 0:
-            train_val = data["train"].train_test_split(
-                test_size=self.val_set_size, shuffle=True, seed=42
-            )
-            train_data = (
-                train_val["train"].shuffle().map(self.tokenize_prompt)
-            )
-            val_data = (
-                train_val["test"].shuffle().map(self.tokenize_prompt)
-            )
-        else:
-            train_data = data["train"].shuffle().map(self.tokenize_prompt)
-            val_data = None
+    def packed_attention(self):
+        prepare = LlamaModel._prepare_decoder_attention_mask
+        if getattr(prepare, "packed", False):
+            return
+
+        def prepare_decoder_attention_mask(model, attention_mask, input_shape, inputs_embeds, past_key_values_length):
+            # segment ids above 1 only come from packed windows, a plain 0/1 mask keeps the stock path
+            if attention_mask is not None and past_key_values_length == 0 and attention_mask.max() > 1:
+                return segment_attention_mask(attention_mask, inputs_embeds.dtype)
 
-        return train_data, val_data
+            return prepare(model, attention_mask, input_shape, inputs_embeds, past_key_values_length)
 
-    def finetune(self, fromdb, iteration):
+        prepare_decoder_attention_mask.packed = True
+        LlamaModel._prepare_decoder_attention_mask = prepare_decoder_attention_mask
+
+    def load_base_model(self):
         self.auto_device()
 
         if not self.lora_target_modules:
@@ -177,81 +171,7 @@ class LLAMASeq2Seq(LLM):
         if self.load_8bit:
             model = prepare_model_for_int8_training(model)
 
-        model = self.load_adapter_config(model)
-
-        data = self.load_train_data(fromdb, iteration)
-        print(data)
-        if not data:
-            print("Warning! Empty Train Data!")
-            return
-
-        train_data, val_data = self.split_train_data(data)
-
-        if self.resume_from_checkpoint:
-            # Check the available weights and load them
-            checkpoint_name = os.path.join(
-                self.resume_from_checkpoint, "pytorch_model.bin"
-            )  # Full checkpoint
-            if not os.path.exists(checkpoint_name):
-                checkpoint_name = os.path.join(
-                    self.resume_from_checkpoint, "adapter_model.bin"
-                )  # only LoRA model - LoRA config above has to fit
-                self.resume_from_checkpoint = (
-                    False  # So the trainer won't try loading its state
-                )
-            # The two files above have a different name depending on how they were saved, but are actually the same.
-            if os.path.exists(checkpoint_name):
-                print(f"Restarting from {checkpoint_name}")
-                adapters_weights = torch.load(checkpoint_name)
-                set_peft_model_state_dict(model, adapters_weights)
-            else:
-                print(f"Checkpoint {checkpoint_name} not found")
-
-        total_batch_size = self.per_gpu_train_batch_size * self.gradient_accumulation_steps * (self.world_size if self.ddp else 1)
-        total_optim_steps = train_data.num_rows // total_batch_size
-        saving_step = int(total_optim_steps / 10)
-        warmup_steps = int(total_optim_steps / 10)
-        train_args = transformers.TrainingArguments(
-            per_device_train_batch_size=self.per_gpu_train_batch_size,
-            gradient_accumulation_steps=self.gradient_accumulation_steps,
-            warmup_steps=warmup_steps,
-            num_train_epochs=self.epochs,
-            learning_rate=self.learning_rate,
-            fp16=self.is_fp16,
-            optim="adamw_torch",
-            logging_steps=self.logging_steps,
-            evaluation_strategy="steps" if self.val_set_size > 0 else "no",
-            save_strategy="steps",
-            eval_steps=saving_step if self.val_set_size > 0 else None,
-            save_steps=saving_step,
-            # max_steps=200,
-            output_dir=self.output_dir,
-            save_total_limit=11,
-            load_best_model_at_end=True if self.val_set_size > 0 else False,
-            ddp_find_unused_parameters=False if self.ddp else None,
-            group_by_length=self.group_by_length,
-            use_mps_device=self.use_mps_device,
-            report_to=None if self.disable_wandb else "wandb"
-        )
-
-        trainer = transformers.Trainer(
-            model=model,
-            train_dataset=train_data,
-            eval_dataset=val_data,
-            args=train_args,
-            data_collator=transformers.DataCollatorForSeq2Seq(self.tokenizer, return_tensors="pt", padding=True),
-        )
-
-        model.config.use_cache = False
-
-        if torch.__version__ >= "2" and sys.platform != "win32":
-            model = torch.compile(model)
-
-        trainer.train(resume_from_checkpoint=self.resume_from_checkpoint)
-
-        model.save_pretrained(self.output_dir)
-
-        print("\n If there's a warning about missing keys above, please disregard :)")
+        return model
 
     def generate_eval_prompt(self, instruction, input=None):
         if input:
@@ -272,67 +192,12 @@ class LLAMASeq2Seq(LLM):
 
     ### Response:"""
 
-    def evaluate(self,
-                 model,
-                 instruction,
-                 input=None,
-                 **kwargs,
-                 ):
-        prompt = self.generate_eval_prompt(instruction, input)
-        inputs = self.tokenizer(prompt, return_tensors="pt")
-        input_ids = inputs["input_ids"].to(self.device)
-        generation_config = GenerationConfig(
-            temperature=self.temperature,
-            top_p=self.top_p,
-            top_k=self.top_k,
-            num_beams=4,
-            do_sample=True,
-            no_repeat_ngram_size=6,
-            repetition_penalty=1.8,
-            **kwargs,
-        )
-        with torch.no_grad():
-            generation_output = model.generate(
-                input_ids=input_ids,
-                generation_config=generation_config,
-                return_dict_in_generate=True,
-                output_scores=True,
-                max_new_tokens=self.max_new_tokens,
-            )
-        s = generation_output.sequences[0]
-        output = self.tokenizer.decode(s)
-
-        return output.split("### Response:")[1].strip()
-
     def generate(self, instruction, input, data, fromdb, type, iteration, test_iteration):
-        self.auto_device()
-
-        model, self.tokenizer = self.get_model_tokenizer()
-
-        if self.adapter_weights != "None":
-            model = PeftModel.from_pretrained(
-                model,
-                self.adapter_weights,
-            )
-
-        if not self.load_8bit:
-            model.half()
-
-        model.to(self.device).eval()
-        if torch.__version__ >= "2" and sys.platform != "win32":
-            model = torch.compile(model)
+        model = self.load_eval_model()
 
         eval_inputs = self.get_eval_input(instruction, input, data, fromdb, type, iteration)
 
-        for item in eval_inputs:
-            try:
-                response = self.evaluate(model, item["instruction"], item["input"])
-                if response[-4:] == "</s>":
-                    response = response[:-4]
-            except:
-                response = "Eval Error"
-
-            item["ac_output"] = response
+        self.eval_items(model, eval_inputs)
 
         self.eval_output(eval_inputs, data, fromdb, type, iteration, test_iteration)
 
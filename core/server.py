@@ -0,0 +1,448 @@
+import json
+import queue
+import threading
+
+from collections import deque
+
+import torch
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from peft import PromptLearningConfig
+from transformers import (
+    LogitsProcessorList,
+    NoRepeatNGramLogitsProcessor,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper
+)
+
+from common.prompt import STOP_MARKERS
+from common.stopping import cut_stop_marker, pending_marker_len
+
+
+def left_pad(tensor, length, value):
+    if tensor.shape[1] >= length:
+        return tensor
+
+    return torch.cat([tensor.new_full((tensor.shape[0], length - tensor.shape[1]), value), tensor], dim=1)
+
+
+def edit_cache(past_key_values, dims, batch_size, fn):
+    """
+    Rebuild past_key_values with fn(tensor, batch_dim, seq_dim) applied to every key and value.
+
+    dims are the batch dim and the key and value sequence dims of the model family, the batch dim may hold
+    batch * heads, it is split so fn always sees the batch alone.
+    """
+    batch_dim, key_seq_dim, value_seq_dim = dims
+    layers = []
+    for layer in past_key_values:
+        tensors = []
+        for tensor, seq_dim in zip(layer, (key_seq_dim, value_seq_dim)):
+            tensor = fn(tensor.unflatten(batch_dim, (batch_size, -1)), batch_dim, seq_dim + 1 if seq_dim > batch_dim else seq_dim)
+            tensors.append(tensor.flatten(batch_dim, batch_dim + 1))
+        layers.append(tuple(tensors))
+
+    return tuple(layers)
+
+
+def select_cache(past_key_values, dims, batch_size, rows, start):
+    """
+    Keep the given batch rows of past_key_values, from sequence position start on.
+    """
+    def select(tensor, batch_dim, seq_dim):
+        tensor = tensor.index_select(batch_dim, rows)
+        return tensor.narrow(seq_dim, start, tensor.shape[seq_dim] - start)
+
+    return edit_cache(past_key_values, dims, batch_size, select)
+
+
+def concat_cache(past_key_values, other, dims, batch_size, other_batch_size, length):
+    """
+    Stack the rows of other below the rows of past_key_values, both left padded with zeros to length positions.
+    """
+    def pad(tensor, batch_dim, seq_dim):
+        shape = list(tensor.shape)
+        shape[seq_dim] = length - shape[seq_dim]
+        return torch.cat([tensor.new_zeros(shape), tensor], dim=seq_dim)
+
+    past_key_values = edit_cache(past_key_values, dims, batch_size, pad)
+    other = edit_cache(other, dims, other_batch_size, pad)
+
+    return tuple(
+        tuple(torch.cat([a, b], dim=dims[0]) for a, b in zip(layer, other_layer))
+        for layer, other_layer in zip(past_key_values, other)
+    )
+
+
+class GenerationRequest:
+    def __init__(self, prompt_ids, max_new_tokens, stream=False, adapter=None):
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.adapter = adapter
+        self.output_ids = []
+        self.output = None
+        self.error = None
+        self.done = threading.Event()
+        # decoded text pieces for streaming clients, None marks the end
+        self.stream = queue.Queue() if stream else None
+        self.streamed = ""
+
+    def finish(self, output=None, error=None):
+        self.output = output
+        self.error = error
+        self.done.set()
+        if self.stream is not None:
+            self.stream.put(None)
+
+
+class Scheduler:
+    r"""
+    Continuous-batching decode loop over a warm model.
+
+    Requests wait in a queue and join the running batch at the next decode step, finished sequences leave it
+    right away, so a long generation never holds back the short ones queued behind it. The KV cache is kept
+    across joins and leaves: a newcomer prefills only its own prompt, which is padded into the running cache, and
+    the rows of finished sequences are dropped from it, along the batch and sequence dims of llm.kv_cache_dims.
+    Prompt learning adapters keep their virtual tokens in the cache, with them the whole batch is prefilled again.
+
+    Decoding follows llm.decoding_profile except for beams, which do not fit a batch whose rows come and go, so
+    the beam profile decodes by sampling here.
+
+    A batch runs on one adapter. Requests are admitted in arrival order while they use the active adapter, the
+    first one asking for another adapter waits for the batch to drain and then switches it.
+    """
+
+    def __init__(self, llm, model, max_batch_size=8):
+        self.llm = llm
+        self.model = model
+        self.tokenizer = llm.tokenizer
+        self.max_batch_size = max(1, max_batch_size)
+
+        self.eos_token_id = self.tokenizer.eos_token_id
+        self.pad_token_id = self.tokenizer.pad_token_id
+        if self.pad_token_id is None:
+            self.pad_token_id = self.eos_token_id if self.eos_token_id is not None else 0
+        config = llm.generation_config()
+        self.do_sample = config.do_sample and config.temperature > 0
+        self.logits_processor = LogitsProcessorList()
+        if config.repetition_penalty and config.repetition_penalty != 1.0:
+            self.logits_processor.append(RepetitionPenaltyLogitsProcessor(config.repetition_penalty))
+        if config.no_repeat_ngram_size:
+            self.logits_processor.append(NoRepeatNGramLogitsProcessor(config.no_repeat_ngram_size))
+        if self.do_sample:
+            self.logits_processor.extend([
+                TemperatureLogitsWarper(config.temperature),
+                TopKLogitsWarper(config.top_k),
+                TopPLogitsWarper(config.top_p),
+            ])
+
+        # enough tokens to spell the longest stop marker even at one character per token
+        self.stop_window = max(len(marker) for marker in STOP_MARKERS) + 1
+
+        self.waiting = deque()
+        self.waiting_cond = threading.Condition()
+        self.running = []
+        self.adapter = llm.default_adapter
+        self.input_ids = None
+        self.attention_mask = None
+        self.past_key_values = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def submit(self, instruction, input=None, max_new_tokens=None, stream=False, adapter=None):
+        adapter = adapter or self.llm.default_adapter
+        if adapter is not None and adapter not in (getattr(self.model, "peft_config", None) or {}):
+            raise KeyError("Unknow adapter: {}".format(adapter))
+
+        prompt = self.llm.generate_eval_prompt(instruction, input)
+        request = GenerationRequest(
+            self.tokenizer(prompt)["input_ids"],
+            max_new_tokens or self.llm.max_new_tokens,
+            stream=stream,
+            adapter=adapter
+        )
+        with self.waiting_cond:
+            self.waiting.append(request)
+            self.waiting_cond.notify()
+
+        return request
+
+    def generate(self, instruction, input=None, max_new_tokens=None, adapter=None):
+        request = self.submit(instruction, input, max_new_tokens, adapter=adapter)
+        request.done.wait()
+        if request.error:
+            raise RuntimeError(request.error)
+
+        return request.output
+
+    def loop(self):
+        while not self.stopped.is_set():
+            try:
+                self.step()
+            except Exception as e:
+                for request in self.running:
+                    request.finish(error="Eval Error: {}".format(e))
+                self.running = []
+                self.past_key_values = None
+
+    def admit(self):
+        admitted = []
+        with self.waiting_cond:
+            if not self.running:
+                # block only when there is nothing to decode
+                self.waiting_cond.wait_for(lambda: self.waiting, timeout=0.1)
+                if self.waiting and self.waiting[0].adapter != self.adapter:
+                    self.llm.use_adapter(self.model, self.waiting[0].adapter)
+                    self.adapter = self.waiting[0].adapter
+
+            while self.waiting and len(self.running) < self.max_batch_size and self.waiting[0].adapter == self.adapter:
+                admitted.append(self.waiting.popleft())
+                self.running.append(admitted[-1])
+
+        return admitted
+
+    def kv_cache_dims(self):
+        peft_config = getattr(self.model, "peft_config", None)
+        if peft_config and isinstance(peft_config[self.model.active_adapter], PromptLearningConfig):
+            return None
+
+        return self.llm.kv_cache_dims
+
+    def rebuild(self):
+        sequences = [request.prompt_ids + request.output_ids for request in self.running]
+        longest = max(len(sequence) for sequence in sequences)
+        device = self.llm.device
+
+        self.input_ids = torch.tensor(
+            [[self.pad_token_id] * (longest - len(sequence)) + sequence for sequence in sequences],
+            dtype=torch.long,
+            device=device
+        )
+        self.attention_mask = torch.tensor(
+            [[0] * (longest - len(sequence)) + [1] * len(sequence) for sequence in sequences],
+            dtype=torch.long,
+            device=device
+        )
+        self.past_key_values = None
+
+    def join(self, requests):
+        """
+        Prefill the prompts of requests, all but their last token which the next decode step feeds with the rest
+        of the batch, and pad them into the running cache.
+        """
+        prefill_len = max(len(request.prompt_ids) for request in requests) - 1
+        if prefill_len == 0:
+            return self.rebuild()  # nothing to prefill but the last tokens
+
+        dims = self.kv_cache_dims()
+        device = self.llm.device
+        batch_size = len(self.running) - len(requests)
+        input_ids = torch.tensor(
+            [[self.pad_token_id] * (prefill_len + 1 - len(request.prompt_ids)) + request.prompt_ids for request in requests],
+            dtype=torch.long,
+            device=device
+        )
+        attention_mask = torch.tensor(
+            [[0] * (prefill_len + 1 - len(request.prompt_ids)) + [1] * len(request.prompt_ids) for request in requests],
+            dtype=torch.long,
+            device=device
+        )
+
+        model_inputs = self.model.prepare_inputs_for_generation(
+            input_ids[:, :-1],
+            attention_mask=attention_mask[:, :-1],
+            use_cache=True,
+        )
+        with torch.no_grad():
+            past_key_values = self.model(**model_inputs, return_dict=True).past_key_values
+
+        # the running rows have everything but their last token in the cache too
+        length = max(self.input_ids.shape[1], prefill_len + 1)
+        self.past_key_values = concat_cache(self.past_key_values, past_key_values, dims, batch_size, len(requests), length - 1)
+        self.input_ids = torch.cat([left_pad(self.input_ids, length, self.pad_token_id), left_pad(input_ids, length, self.pad_token_id)])
+        self.attention_mask = torch.cat([left_pad(self.attention_mask, length, 0), left_pad(attention_mask, length, 0)])
+
+    def leave(self, keep):
+        """
+        Drop all but the rows keep from the running batch, with the left padding no remaining row needs.
+        """
+        rows = torch.tensor(keep, dtype=torch.long, device=self.input_ids.device)
+        batch_size = self.input_ids.shape[0]
+        self.input_ids = self.input_ids.index_select(0, rows)
+        self.attention_mask = self.attention_mask.index_select(0, rows)
+        start = int((self.attention_mask == 0).sum(dim=-1).min())
+
+        self.past_key_values = select_cache(self.past_key_values, self.kv_cache_dims(), batch_size, rows, start)
+        self.input_ids = self.input_ids[:, start:]
+        self.attention_mask = self.attention_mask[:, start:]
+
+    def sample(self, logits):
+        scores = logits.float()
+        if len(self.logits_processor):
+            # every row on its own tokens, so the left padding never counts as a repeated token
+            starts = (self.attention_mask == 0).sum(dim=-1).tolist()
+            scores = torch.cat([
+                self.logits_processor(self.input_ids[i:i + 1, start:], scores[i:i + 1])
+                for i, start in enumerate(starts)
+            ])
+        if not self.do_sample:
+            return scores.argmax(dim=-1)
+
+        return torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+
+    def response(self, request):
+        text = self.tokenizer.decode(request.output_ids, skip_special_tokens=True)
+        if self.llm.stop_markers:
+            return cut_stop_marker(text)
+
+        return text, False
+
+    def hit_stop_marker(self, request):
+        tail = self.tokenizer.decode(request.output_ids[-self.stop_window:], skip_special_tokens=True)
+
+        return cut_stop_marker(tail)[1]
+
+    def push(self, request):
+        text, stopped = self.response(request)
+        # wait for the rest of a multi-byte character or a possible stop marker before sending it
+        if text.endswith("\ufffd"):
+            return
+        if self.llm.stop_markers and not stopped:
+            text = text[:len(text) - pending_marker_len(text)]
+        if len(text) <= len(request.streamed):
+            return
+        request.stream.put(text[len(request.streamed):])
+        request.streamed = text
+
+    def flush(self, request):
+        text = self.response(request)[0]
+        if len(text) > len(request.streamed):
+            request.stream.put(text[len(request.streamed):])
+            request.streamed = text
+
+    def step(self):
+        admitted = self.admit()
+        if not self.running:
+            return
+        if self.past_key_values is None or (admitted and self.kv_cache_dims() is None):
+            self.rebuild()
+        elif admitted:
+            self.join(admitted)
+
+        model_inputs = self.model.prepare_inputs_for_generation(
+            self.input_ids,
+            past_key_values=self.past_key_values,
+            attention_mask=self.attention_mask,
+            use_cache=True,
+        )
+        with torch.no_grad():
+            outputs = self.model(**model_inputs, return_dict=True)
+        self.past_key_values = outputs.past_key_values
+
+        next_tokens = self.sample(outputs.logits[:, -1, :])
+        self.input_ids = torch.cat([self.input_ids, next_tokens[:, None]], dim=-1)
+        self.attention_mask = torch.cat([self.attention_mask, self.attention_mask.new_ones((len(self.running), 1))], dim=-1)
+
+        finished = []
+        for request, token in zip(self.running, next_tokens.tolist()):
+            if token == self.eos_token_id:
+                finished.append(request)
+                continue
+            request.output_ids.append(token)
+            if request.stream is not None:
+                self.push(request)
+            if len(request.output_ids) >= request.max_new_tokens or (self.llm.stop_markers and self.hit_stop_marker(request)):
+                finished.append(request)
+
+        if finished:
+            for request in finished:
+                if request.stream is not None:
+                    self.flush(request)
+                request.finish(output=self.response(request)[0].strip())
+            keep = [i for i, request in enumerate(self.running) if not request.done.is_set()]
+            self.running = [self.running[i] for i in keep]
+            if self.running and self.kv_cache_dims() is not None:
+                self.leave(keep)
+            else:
+                self.past_key_values = None
+
+
+def serve(llm, model, host="127.0.0.1", port=8000):
+    scheduler = Scheduler(llm, model, max_batch_size=llm.batch_size)
+    scheduler.start()
+
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, code, body):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def reply_stream(self, request):
+            # one json object per line, flushed as soon as the scheduler decodes new text
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+            while True:
+                text = request.stream.get()
+                if text is None:
+                    break
+                self.wfile.write((json.dumps({"text": text}, ensure_ascii=False) + "\n").encode("utf-8"))
+                self.wfile.flush()
+            if request.error:
+                body = {"error": request.error}
+            else:
+                body = {"output": request.output}
+            self.wfile.write((json.dumps(body, ensure_ascii=False) + "\n").encode("utf-8"))
+
+        def do_GET(self):
+            if self.path != "/health":
+                return self.reply(404, {"error": "Not Found"})
+            self.reply(200, {"status": "ok", "running": len(scheduler.running), "waiting": len(scheduler.waiting)})
+
+        def do_POST(self):
+            if self.path != "/generate":
+                return self.reply(404, {"error": "Not Found"})
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                instruction = body["instruction"]
+            except (ValueError, KeyError):
+                return self.reply(400, {"error": "Body should be a json like {\"instruction\": ..., \"input\": ...}"})
+
+            try:
+                request = scheduler.submit(
+                    instruction,
+                    body.get("input"),
+                    body.get("max_new_tokens"),
+                    body.get("stream", False),
+                    body.get("adapter")
+                )
+            except KeyError as e:
+                return self.reply(400, {"error": e.args[0]})
+            if request.stream is not None:
+                return self.reply_stream(request)
+            request.done.wait()
+            if request.error:
+                return self.reply(500, {"error": request.error})
+            self.reply(200, {"output": request.output})
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print("Serving on http://{}:{}, POST /generate with {{\"instruction\": ..., \"input\": ...}}".format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        scheduler.stop()
@@ -0,0 +1,143 @@
+import torch
+import transformers
+
+from contextlib import contextmanager
+from torch.utils.checkpoint import checkpoint
+from torch.utils.data import DataLoader
+from transformers.trainer_utils import seed_worker
+
+from common.base import IGNORE_INDEX
+from common.device import RSSPeak, peak_memory_mb
+
+
+@contextmanager
+def skip_output_embeddings(causal_lm):
+    """
+    Swap the lm head of causal_lm for an identity, so its forward returns hidden states where the logits would be.
+    """
+    lm_head = causal_lm.get_output_embeddings()
+    name = next(name for name, module in causal_lm.named_children() if module is lm_head)
+    setattr(causal_lm, name, torch.nn.Identity())
+    try:
+        yield lm_head
+    finally:
+        setattr(causal_lm, name, lm_head)
+
+
+def chunked_causal_lm_loss(hidden_states, labels, lm_head, chunk_size):
+    """
+    Mean next-token cross entropy over the labels that are not IGNORE_INDEX, the same as the model's own loss.
+
+    Only the kept positions go through lm_head, chunk_size of them at a time and recomputed in backward, so at
+    most a (chunk_size, vocab) slice of the logits is alive instead of (batch, seq, vocab).
+    """
+    labels = labels[:, 1:].to(hidden_states.device)
+    keep = labels != IGNORE_INDEX
+    hidden_states = hidden_states[:, :-1][keep]
+    labels = labels[keep]
+
+    def chunk_loss(hidden, target):
+        logits = lm_head(hidden.to(lm_head.weight.dtype)).float()
+        return torch.nn.functional.cross_entropy(logits, target, reduction="sum")
+
+    # starts from the hidden states so a batch without any label still backpropagates
+    loss = hidden_states.float().sum() * 0.0
+    for start in range(0, labels.numel(), chunk_size):
+        loss = loss + checkpoint(
+            chunk_loss,
+            hidden_states[start:start + chunk_size],
+            labels[start:start + chunk_size],
+            use_reentrant=False
+        )
+
+    return loss / max(1, labels.numel())
+
+
+class LLMTrainer(transformers.Trainer):
+    r"""
+    Trainer taking an optional batch sampler for the train data, e.g. a token budget instead of a sample count,
+    and an optional inputs_hook finishing every batch once it is on the device, e.g. expanding compact masks.
+
+    With loss_chunk_size the train loss of a causal lm is computed in chunks from the hidden states, the full
+    logits are never built. Every log carries the peak memory since the previous one, and a ThroughputCallback
+    passed as throughput sees every train batch.
+    """
+
+    def __init__(
+            self,
+            *args,
+            train_batch_sampler=None,
+            inputs_hook=None,
+            loss_chunk_size=None,
+            throughput=None,
+            **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.train_batch_sampler = train_batch_sampler
+        self.inputs_hook = inputs_hook
+        self.loss_chunk_size = loss_chunk_size
+        self.throughput = throughput
+        # ru_maxrss cannot be reset, off cuda the peak memory is sampled from the start
+        self.rss_peak = RSSPeak() if self.args.device.type != "cuda" else None
+        if throughput is not None:
+            self.add_callback(throughput)
+
+    def _prepare_inputs(self, inputs):
+        inputs = super()._prepare_inputs(inputs)
+        if self.inputs_hook is not None:
+            inputs = self.inputs_hook(inputs)
+
+        return inputs
+
+    def training_step(self, model, inputs):
+        if self.throughput is None:
+            return super().training_step(model, inputs)
+
+        self.throughput.batch_start(inputs)
+        loss = super().training_step(model, inputs)
+        self.throughput.batch_end()
+
+        return loss
+
+    def compute_loss(self, model, inputs, return_outputs=False):
+        if not self.loss_chunk_size or return_outputs or "labels" not in inputs:
+            return super().compute_loss(model, inputs, return_outputs)
+
+        inputs = dict(inputs)
+        labels = inputs.pop("labels")
+        # forward through the wrapped model (ddp, peft), only the lm head is skipped
+        causal_lm = self.accelerator.unwrap_model(model).get_base_model()
+        with skip_output_embeddings(causal_lm) as lm_head:
+            hidden_states = model(**inputs).logits
+
+        return chunked_causal_lm_loss(hidden_states, labels, lm_head, self.loss_chunk_size)
+
+    def log(self, logs):
+        device = self.args.device.type
+        if device == "cuda":
+            logs["peak_memory_mb"] = round(peak_memory_mb(device), 1)
+        else:
+            logs["peak_memory_mb"] = round(self.rss_peak.peak_mb(), 1)
+        super().log(logs)
+
+        # after the callbacks have seen it, so every log has the peak since the previous one
+        if device == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+        else:
+            self.rss_peak.reset()
+
+    def get_train_dataloader(self):
+        if self.train_batch_sampler is None:
+            return super().get_train_dataloader()
+
+        train_dataset = self._remove_unused_columns(self.train_dataset, description="training")
+        train_dataloader = DataLoader(
+            train_dataset,
+            batch_sampler=self.train_batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+            worker_init_fn=seed_worker,
+        )
+
+        return self.accelerator.prepare(train_dataloader)
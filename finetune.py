@@ -49,6 +49,14 @@ if __name__ == "__main__":
     parser.add_argument('--val_set_size', default=0.2, type=float)
     parser.add_argument('--group_by_length', action="store_true")
     parser.add_argument('--logging_steps', default=20, type=int)
+    parser.add_argument('--num_proc', default=1, type=int, help="Processes used to tokenize the train data")
+    parser.add_argument('--packing', action="store_true", help="Pack short examples into cutoff_len windows, llama with lora/qlora/adalora only")
+    parser.add_argument('--streaming', action="store_true", help="Read and tokenize the train data lazily instead of loading it all")
+    parser.add_argument('--shuffle_buffer_size', default=10000, type=int, help="Rows shuffled together when streaming")
+    parser.add_argument('--val_stream_size', default=1000, type=int, help="Rows held out for validation when streaming")
+    parser.add_argument('--max_steps', default=-1, type=int, help="Stop after this many optimizer steps, required when streaming")
+    parser.add_argument('--tokenized_cache', default="data/cache", type=str,
+                        help="The DIR caching tokenized train data between runs, None to always re-tokenize")
 
     parser.add_argument('--load_8bit', action="store_true")
     parser.add_argument('--add_eos_token', action="store_true")
@@ -56,9 +64,26 @@ if __name__ == "__main__":
                         help='resume from the specified or the latest checkpoint, e.g. `--resume_from_checkpoint [path]` or `--resume_from_checkpoint`')
     parser.add_argument('--per_gpu_train_batch_size', default=4, type=int, help='Batch size per GPU/CPU for training.')
     parser.add_argument('--gradient_accumulation_steps', default=32, type=int)
+    parser.add_argument('--device', default=None, choices=['cuda', 'mps', 'cpu'], help="Detected automatically by default")
+    parser.add_argument('--disable_bf16', action="store_true", help="Train in plain fp32 on cpu even when bf16 is supported")
+    parser.add_argument('--cpu_threads', default=None, type=int, help="Threads used on cpu, all available cpus by default")
+    parser.add_argument('--dataloader_num_workers', default=None, type=int, help="2 on cpu, 0 otherwise by default")
+    parser.add_argument('--memory_saver', action="store_true", help="Gradient checkpointing and a chunked loss that never builds the full logits")
+    parser.add_argument('--loss_chunk_size', default=1024, type=int, help="Label positions per lm head chunk with --memory_saver")
+    parser.add_argument('--throughput_sync', action="store_true",
+                        help="Synchronize cuda after every micro batch for an exact compute vs data wait split, slows training down")
+    parser.add_argument('--save_steps', default=None, type=int, help="Save the adapter in the background every n optimizer steps")
+    parser.add_argument('--save_minutes', default=None, type=float, help="Save the adapter in the background every n minutes")
+    parser.add_argument('--max_train_batch_tokens', default=None, type=int,
+                        help="Fill each batch up to this many padded tokens instead of per_gpu_train_batch_size samples")
+
+    parser.add_argument('--sweep', default=None, type=str,
+                        help="Adapter configs trained one after another on the same base model and data, a json list or a json file, "
+                             "e.g. '[{\"lora_r\": 8}, {\"lora_r\": 16, \"learning_rate\": 1e-4}]'")
 
     parser.add_argument('--fromdb', action="store_true")
     parser.add_argument('--db_iteration', default=None, type=str, help="The record's set name.")
+    parser.add_argument('--db_chunk_size', default=10000, type=int, help="Rows fetched from the db at a time")
 
     args, _ = parser.parse_known_args()
 
@@ -122,19 +147,49 @@ if __name__ == "__main__":
     llm.val_set_size = args.val_set_size
     llm.group_by_length = args.group_by_length
     llm.logging_steps = args.logging_steps
+    llm.num_proc = args.num_proc
+    llm.tokenized_cache = args.tokenized_cache
+    llm.packing = args.packing
+    llm.streaming = args.streaming
+    llm.shuffle_buffer_size = args.shuffle_buffer_size
+    llm.val_stream_size = args.val_stream_size
+    llm.max_steps = args.max_steps
+    llm.db_chunk_size = args.db_chunk_size
 
     llm.load_8bit = args.load_8bit
     llm.add_eos_token = args.add_eos_token
     llm.resume_from_checkpoint = args.resume_from_checkpoint
     llm.per_gpu_train_batch_size = args.per_gpu_train_batch_size
     llm.gradient_accumulation_steps = args.gradient_accumulation_steps
+    llm.max_train_batch_tokens = args.max_train_batch_tokens
+    llm.memory_saver = args.memory_saver
+    llm.loss_chunk_size = args.loss_chunk_size
+    llm.throughput_sync = args.throughput_sync
+    llm.save_steps = args.save_steps
+    llm.save_minutes = args.save_minutes
+    llm.device = args.device
+    llm.disable_bf16 = args.disable_bf16
+    llm.cpu_threads = args.cpu_threads
+    llm.dataloader_num_workers = args.dataloader_num_workers
 
     if not os.path.exists(llm.output_dir):
         os.makedirs(llm.output_dir)
         print("Warning: Directory {} Not Found, create automatically")
 
+    if llm.streaming and llm.max_steps <= 0:
+        print("A streamed dataset has no length, please set --max_steps with --streaming")
+        sys.exit(-1)
+
     if llm.adapter == "qlora" and sys.platform == "darwin":
         print("Unfortunately, SuperAdapters do not support qlora on Mac, please use lora/adalora instead")
         sys.exit(-1)
 
-    llm.finetune(args.fromdb, args.db_iteration)
+    if args.sweep:
+        if os.path.isfile(args.sweep):
+            with open(args.sweep) as f:
+                configs = json.load(f)
+        else:
+            configs = json.loads(args.sweep)
+        llm.sweep(args.fromdb, args.db_iteration, configs)
+    else:
+        llm.finetune(args.fromdb, args.db_iteration)
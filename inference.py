@@ -1,6 +1,8 @@
 import sys
 import argparse
 
+from common.base import DECODING_PROFILES
+
 from core.seq2seq.chatglm import ChatGLMSeq2Seq
 from core.seq2seq.llama import LLAMASeq2Seq
 from core.seq2seq.bloom import BLoomSeq2Seq
@@ -24,6 +26,12 @@ if __name__ == "__main__":
                         help="Labels to classify, only used when task_type is classify")
     parser.add_argument('--model_path', default="LLMs/open-llama/openllama-3b", type=str)
     parser.add_argument('--adapter_weights', default="None", type=str, help="The DIR of adapter weights")
+    parser.add_argument('--adapters', nargs='+', default=None,
+                        help="More adapters on the same base model, e.g. `name=output/llama` or `output/` for all of its sub dirs. "
+                             "Pick one per input with its 'adapter' field")
+    parser.add_argument('--merge_adapter', action="store_true",
+                        help="Merge lora/qlora/adalora adapter_weights into the base once, cache the fused checkpoint and load it directly")
+    parser.add_argument('--fused_dir', default="output/fused", type=str, help="The DIR to cache fused checkpoints")
 
     parser.add_argument('--load_8bit', action="store_true")
 
@@ -32,6 +40,28 @@ if __name__ == "__main__":
     parser.add_argument('--top_p', default="0.9", type=float)
     parser.add_argument('--top_k', default="40", type=int)
     parser.add_argument('--max_new_tokens', default="512", type=int)
+    parser.add_argument('--decoding_profile', default="beam", choices=list(DECODING_PROFILES),
+                        help="beam is the most careful, greedy-fast the fastest")
+    parser.add_argument('--output_scores', action="store_true", help="Keep the per step scores of model.generate")
+    parser.add_argument('--disable_stop_markers', action="store_true",
+                        help="Do not end a response when it starts a '### Human:'/'### Instruction:'/... section of its own")
+    parser.add_argument('--batch_size', default=1, type=int,
+                        help="Generate this many inputs per model.generate call, sorted by length and left-padded")
+    parser.add_argument('--max_batch_tokens', default=8192, type=int,
+                        help="Token budget of a classify batch, only used when task_type is classify and batch_size > 1")
+
+    parser.add_argument('--stream', action="store_true", help="Print the response of --instruction token by token")
+    parser.add_argument('--prefix_cache', action="store_true",
+                        help="Compute the prompt template preamble's past_key_values once and reuse them for every input")
+
+    parser.add_argument('--response_cache', default=None, type=str,
+                        help="SQLite file to memoize responses, identical model/adapter/prompt/params are not generated again")
+    parser.add_argument('--response_cache_size', default=100000, type=int, help="Max responses kept, least recently used go first")
+
+    # server
+    parser.add_argument('--serve', action="store_true", help="Keep the model warm and answer HTTP requests")
+    parser.add_argument('--host', default="127.0.0.1", type=str)
+    parser.add_argument('--port', default=8000, type=int)
 
     # fromdb
     parser.add_argument('--fromdb', action="store_true")
@@ -76,6 +106,9 @@ if __name__ == "__main__":
 
     llm.base_model = args.model_path
     llm.adapter_weights = args.adapter_weights
+    llm.adapters = llm.find_adapters(args.adapters)
+    llm.merge_adapter = args.merge_adapter
+    llm.fused_dir = args.fused_dir
 
     llm.load_8bit = args.load_8bit
 
@@ -83,6 +116,25 @@ if __name__ == "__main__":
     llm.top_p = args.top_p
     llm.top_k = args.top_k
     llm.max_new_tokens = args.max_new_tokens
-
-    llm.generate(args.instruction, args.input, args.data, args.fromdb, args.db_type, args.db_iteration, args.db_test_iteration)
+    llm.decoding_profile = args.decoding_profile
+    llm.output_scores = args.output_scores
+    llm.stop_markers = not args.disable_stop_markers
+    llm.batch_size = args.batch_size
+    llm.max_batch_tokens = args.max_batch_tokens
+    llm.prefix_cache = args.prefix_cache
+    llm.response_cache = args.response_cache
+    llm.response_cache_size = args.response_cache_size
+
+    if args.serve:
+        if args.task_type != "seq2seq":
+            print("Serve with task_type classify is not support now.")
+            sys.exit(-1)
+        llm.serve(args.host, args.port)
+    elif args.stream:
+        if args.task_type != "seq2seq":
+            print("Stream with task_type classify is not support now.")
+            sys.exit(-1)
+        llm.stream(args.instruction, args.input)
+    else:
+        llm.generate(args.instruction, args.input, args.data, args.fromdb, args.db_type, args.db_iteration, args.db_test_iteration)
 
@@ -0,0 +1,45 @@
+import torch
+
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+from core.seq2seq.llama import LLAMASeq2Seq
+from test_train import bpe_tokenizer
+
+
+def test_batch_evaluate_matches_one_by_one():
+    # no pad token, so batches are padded with eos, which the responses must keep ending on
+    tokenizer = bpe_tokenizer()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer.backend_tokenizer, eos_token="</s>")
+    llm = LLAMASeq2Seq()
+    llm.tokenizer = tokenizer
+    llm.device = "cpu"
+    llm.decoding_profile = "greedy-fast"
+    llm.max_new_tokens = 12
+    llm.batch_size = 3
+
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer), hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+        num_attention_heads=4, eos_token_id=tokenizer.eos_token_id
+    )
+    model = LlamaForCausalLM(config).eval()
+    # turn the 4th greedy token of one prompt into eos, so that rows finish early and are padded after it
+    input_ids = tokenizer(llm.generate_eval_prompt("why", ""), return_tensors="pt")["input_ids"]
+    with torch.no_grad():
+        token = model.generate(input_ids=input_ids, max_new_tokens=4, do_sample=False)[0, -1]
+        model.lm_head.weight[tokenizer.eos_token_id] = 1.1 * model.lm_head.weight[token]
+
+    eval_inputs = [
+        {"instruction": instruction, "input": input}
+        for instruction, input in [
+            ("why", ""), ("the cat sat on a mat", ""), ("is the sky blue", "and why"), ("a", "the cat"), ("asked", "")
+        ]
+    ]
+    llm.batch_evaluate(model, eval_inputs)
+
+    assert tokenizer.pad_token is None and tokenizer.padding_side == "right"
+    for item in eval_inputs:
+        response = llm.evaluate(model, item["instruction"], item["input"])
+        if response[-4:] == "</s>":
+            response = response[:-4]
+        assert item["ac_output"] == response
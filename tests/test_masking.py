@@ -0,0 +1,83 @@
+import re
+import random
+
+import pytest
+
+from common.base import IGNORE_INDEX
+from common.masking import mask_spans
+
+
+def scan_mask_spans(labels, offsets, spans):
+    # the per-span scan over all offsets that tokenize_prompt used before common.masking
+    for start_pos, end_pos in spans:
+        start_idx = None
+        end_idx = None
+        for i, (start, end) in enumerate(offsets):
+            if start <= start_pos < end:
+                start_idx = i
+            if start <= end_pos < end:
+                end_idx = i
+        if start_idx is not None and end_idx is not None:
+            for i in range(start_idx, end_idx - 1):
+                labels[i] = IGNORE_INDEX
+
+    return labels
+
+
+def random_offsets(rng, length):
+    """
+    Contiguous tokens with gaps, (0, 0) special tokens, overlapping pieces and now and then out of order.
+    """
+    offsets = []
+    pos = 0
+    while pos < length:
+        kind = rng.random()
+        if kind < 0.1:
+            offsets.append((0, 0))
+            continue
+        if kind < 0.2:
+            pos += rng.randint(1, 3)  # chars no token covers
+            continue
+        end = min(length, pos + rng.randint(1, 6))
+        if kind < 0.3 and offsets:
+            offsets.append((max(0, pos - rng.randint(1, 3)), end))  # overlaps the previous token
+        else:
+            offsets.append((pos, end))
+        pos = end
+    if rng.random() < 0.2 and len(offsets) > 1:
+        i, j = rng.sample(range(len(offsets)), 2)
+        offsets[i], offsets[j] = offsets[j], offsets[i]
+
+    return offsets
+
+
+def random_spans(rng, length):
+    spans = []
+    for _ in range(rng.randint(0, 8)):
+        start_pos = rng.randint(0, length + 3)  # may lie past the last token
+        spans.append((start_pos, start_pos + rng.randint(0, 40)))
+
+    return spans
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_mask_spans_matches_offset_scan(seed):
+    rng = random.Random(seed)
+    length = rng.randint(0, 200)
+    offsets = random_offsets(rng, length)
+    spans = random_spans(rng, length)
+    labels = [rng.randint(0, 1000) for _ in offsets]
+
+    assert mask_spans(list(labels), offsets, spans) == scan_mask_spans(list(labels), offsets, spans)
+
+
+def test_mask_spans_dialogue():
+    # whitespace "tokens" of a two round dialogue, the human turns are masked
+    prompt = "### Human: hi there </s>### Assistant: hello </s>### Human: bye now </s>### Assistant: ok </s>"
+    offsets = [(0, 0)] + [match.span() for match in re.finditer(r"\s*\S+", prompt)]
+    spans = [match.span() for match in re.finditer(r'### (?!Assistant:)(.*?)</s>', prompt, re.DOTALL)]
+    labels = list(range(len(offsets)))
+
+    masked = mask_spans(list(labels), offsets, spans)
+    assert masked == scan_mask_spans(list(labels), offsets, spans)
+    assert masked.count(IGNORE_INDEX) == 6
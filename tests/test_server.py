@@ -0,0 +1,77 @@
+import pytest
+import torch
+
+from transformers import BloomConfig, BloomForCausalLM, LlamaConfig, LlamaForCausalLM
+
+from core.seq2seq.bloom import BLoomSeq2Seq
+from core.seq2seq.llama import LLAMASeq2Seq
+from core.server import Scheduler
+
+
+class CharTokenizer:
+    """
+    One token per character, enough for the scheduler and a tiny random model.
+    """
+    pad_token_id = 0
+    eos_token_id = 1
+    vocab_size = 128
+
+    def __call__(self, text):
+        return {"input_ids": [2 + ord(c) % (self.vocab_size - 2) for c in text]}
+
+    def decode(self, ids, skip_special_tokens=False):
+        return "".join(chr(i) for i in ids if i > 1)
+
+
+def tiny_llama():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=CharTokenizer.vocab_size, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+        num_attention_heads=4, pad_token_id=0, bos_token_id=2, eos_token_id=1
+    )
+    return LLAMASeq2Seq(), LlamaForCausalLM(config).eval()
+
+
+def tiny_bloom():
+    torch.manual_seed(0)
+    config = BloomConfig(
+        vocab_size=CharTokenizer.vocab_size, hidden_size=32, n_layer=2, n_head=4,
+        pad_token_id=0, bos_token_id=2, eos_token_id=1
+    )
+    return BLoomSeq2Seq(), BloomForCausalLM(config).eval()
+
+
+@pytest.mark.parametrize("build", [tiny_llama, tiny_bloom])
+@pytest.mark.parametrize("repetition_penalty", [1.0, 1.8])
+def test_scheduler_matches_sequential_generate(build, repetition_penalty):
+    llm, model = build()
+    llm.tokenizer = CharTokenizer()
+    llm.device = "cpu"
+    llm.stop_markers = False
+    llm.decoding_profile = "greedy-fast"
+    config = llm.generation_config(repetition_penalty=repetition_penalty)
+    llm.generation_config = lambda **kwargs: config
+
+    # different prompt and output lengths, so sequences join and leave a running batch of 2
+    jobs = [("hi", None, 5), ("tell me a story", "about a cat", 12), ("why", None, 3), ("2 + 2 =", None, 9), ("x" * 40, None, 6)]
+
+    scheduler = Scheduler(llm, model, max_batch_size=2)
+    requests = [scheduler.submit(instruction, input, max_new_tokens) for instruction, input, max_new_tokens in jobs]
+    while not all(request.done.is_set() for request in requests):
+        scheduler.step()
+
+    for request, (instruction, input, max_new_tokens) in zip(requests, jobs):
+        prompt_ids = llm.tokenizer(llm.generate_eval_prompt(instruction, input))["input_ids"]
+        with torch.no_grad():
+            output = model.generate(
+                input_ids=torch.tensor([prompt_ids]),
+                generation_config=config,
+                max_new_tokens=max_new_tokens,
+                pad_token_id=0,
+                eos_token_id=1,
+            )[0, len(prompt_ids):].tolist()
+        if 1 in output:
+            output = output[:output.index(1)]
+
+        assert request.error is None
+        assert request.output_ids == output
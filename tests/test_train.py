@@ -0,0 +1,105 @@
+import os
+import json
+import shutil
+
+import pytest
+import torch
+
+from peft import LoraConfig, get_peft_model
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+from common.prompt import PROMPT_DICT
+from core.seq2seq.llama import LLAMASeq2Seq
+
+WORDS = "the cat sat on a mat and asked why the sky is blue".split()
+
+
+def bpe_tokenizer():
+    """
+    A small byte level BPE fast tokenizer, trained in memory on the prompt templates.
+    """
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.train_from_iterator(
+        list(PROMPT_DICT.values()) + [" ".join(WORDS)] * 5,
+        trainers.BpeTrainer(
+            vocab_size=300, special_tokens=["<unk>", "<pad>", "</s>"], initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+        )
+    )
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="</s>", pad_token="<pad>")
+
+
+def tiny_lora_llama(tmp_path, rows=40, **kwargs):
+    """
+    LLAMASeq2Seq set up to train a LoRA on a tiny random llama on cpu, with rows train examples in a jsonl file.
+    """
+    data_path = tmp_path / "train.jsonl"
+    with open(data_path, "w") as f:
+        for i in range(rows):
+            words = [WORDS[(i + j) % len(WORDS)] for j in range(8)]
+            f.write(json.dumps({"instruction": " ".join(words[:4]), "input": "", "output": " ".join(words[4:])}) + "\n")
+
+    llm = LLAMASeq2Seq()
+    llm.tokenizer = bpe_tokenizer()
+    llm.data_path = str(data_path)
+    llm.output_dir = str(tmp_path / "output")
+    llm.device = "cpu"
+    llm.is_fp16 = False
+    llm.disable_wandb = True
+    llm.tokenized_cache = None
+    llm.cutoff_len = 64
+    llm.per_gpu_train_batch_size = 2
+    llm.gradient_accumulation_steps = 1
+    llm.logging_steps = 1
+    for name, value in kwargs.items():
+        setattr(llm, name, value)
+
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=len(llm.tokenizer), hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+        num_attention_heads=4, pad_token_id=llm.tokenizer.pad_token_id, eos_token_id=llm.tokenizer.eos_token_id
+    )
+    model = get_peft_model(
+        LlamaForCausalLM(config), LoraConfig(r=4, target_modules=["q_proj", "v_proj"], task_type="CAUSAL_LM")
+    )
+    return llm, model
+
+
+@pytest.fixture(autouse=True)
+def no_compile(monkeypatch):
+    # LLM.train compiles the model on torch 2, which only costs time here
+    monkeypatch.setattr(torch, "compile", lambda model: model)
+
+
+def test_streaming_with_dataloader_workers(tmp_path):
+    llm, model = tiny_lora_llama(
+        tmp_path, streaming=True, val_set_size=4, val_stream_size=4, max_steps=3, dataloader_num_workers=2
+    )
+    train_data, val_data = llm.split_train_data(llm.load_train_data(False, None))
+
+    trainer = llm.train(model, train_data, val_data)
+
+    assert trainer.state.global_step == 3
+
+
+def test_async_checkpoint_resumes_to_the_same_step(tmp_path, monkeypatch):
+    # transformers 4.31 loads rng_state.pth with the torch.load defaults, which torch >= 2.6 limits to weights
+    monkeypatch.setenv("TORCH_FORCE_NO_WEIGHTS_ONLY_LOAD", "1")
+    options = dict(val_set_size=0, max_steps=6, save_steps=3, dataloader_num_workers=0)
+    llm, model = tiny_lora_llama(tmp_path, **options)
+    train_data, _ = llm.split_train_data(llm.load_train_data(False, None))
+    losses = {log["step"]: log["loss"] for log in llm.train(model, train_data, None).state.log_history if "loss" in log}
+    assert os.path.isdir(os.path.join(llm.output_dir, "checkpoint-3"))
+
+    # as if training had died right after the step 3 save
+    shutil.rmtree(os.path.join(llm.output_dir, "checkpoint-6"))
+    llm, model = tiny_lora_llama(tmp_path, resume_from_checkpoint=True, **options)
+    llm.resume_adapter(model)
+    trainer = llm.train(model, train_data, None)
+    resumed = {log["step"]: log["loss"] for log in trainer.state.log_history if "loss" in log}
+
+    assert trainer.state.global_step == 6
+    for step in (4, 5, 6):
+        assert resumed[step] == pytest.approx(losses[step], rel=1e-4)